@@ -0,0 +1,104 @@
+"""Micro-benchmarks for the game's hot paths
+
+Usage (from the repository root):
+
+    python -m benchmarks [--save-baseline] [--threshold 0.25] [NAME ...]
+
+Each run is appended to benchmarks/results/history.jsonl. If there's a
+baseline (benchmarks/results/baseline.json, written by --save-baseline),
+cases that got slower by more than the threshold are flagged, and the exit
+status is 1.
+
+Times are the best of several repeats, per call of the benchmarked function.
+Cases that need OpenGL use a standalone (headless) context, and are skipped
+if none can be created.
+"""
+
+from pathlib import Path
+import subprocess
+import argparse
+import platform
+import timeit
+import json
+import time
+import sys
+
+from .cases import CASES, get_ctx, ROOT
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+
+def measure(func, repeat=5, min_time=0.2):
+    timer = timeit.Timer(func)
+    number, total = timer.autorange()
+    number = max(1, int(number * min_time / max(total, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, capture_output=True, encoding='utf-8', check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def format_time(seconds):
+    for unit, scale in ('s', 1), ('ms', 1e-3), ('µs', 1e-6):
+        if seconds >= scale:
+            return f'{seconds/scale:.3g} {unit}'
+    return f'{seconds/1e-9:.3g} ns'
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+        help='run only cases whose names contain one of these')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='relative slowdown that counts as a regression')
+    parser.add_argument('--results-dir', type=Path, default=RESULTS_DIR)
+    args = parser.parse_args(argv)
+
+    baseline_path = args.results_dir / 'baseline.json'
+    try:
+        baseline = json.loads(baseline_path.read_text())['times']
+    except (OSError, ValueError, KeyError):
+        baseline = {}
+
+    times = {}
+    regressions = []
+    for name, make_case in CASES.items():
+        if args.names and not any(n in name for n in args.names):
+            continue
+        if make_case.needs_gl and get_ctx() is None:
+            print(f'{name:40} skipped (no OpenGL context)')
+            continue
+        result = times[name] = measure(make_case())
+        line = f'{name:40} {format_time(result):>10}'
+        if name in baseline:
+            change = result / baseline[name] - 1
+            line += f' {change:+7.1%}'
+            if change > args.threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line, flush=True)
+
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'times': times,
+    }
+    args.results_dir.mkdir(parents=True, exist_ok=True)
+    with open(args.results_dir / 'history.jsonl', 'a') as f:
+        print(json.dumps(record), file=f)
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(record, indent=1))
+        print(f'Saved baseline to {baseline_path}')
+    if regressions:
+        print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
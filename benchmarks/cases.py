@@ -0,0 +1,202 @@
+"""The benchmarks
+
+Each case is a function that does the setup and returns a function to time.
+Setup that's shared between cases (the track, a GL context) is cached.
+"""
+
+from pathlib import Path
+import functools
+import random
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'leveledit'))
+
+from keypad_racer.physics import Track, RacingCar
+from keypad_racer import resources
+
+LEVEL = ROOT / 'okruh.png'
+
+CASES = {}
+
+def case(name, needs_gl=False):
+    def decorator(func):
+        func.needs_gl = needs_gl
+        CASES[name] = func
+        return func
+    return decorator
+
+@functools.lru_cache()
+def get_track():
+    return Track(LEVEL)
+
+@functools.lru_cache()
+def get_ctx():
+    """Return a headless moderngl context, or None if there's none"""
+    import types
+    try:
+        import moderngl
+    except ImportError:
+        return None
+    for kwargs in {'backend': 'egl'}, {}:
+        try:
+            ctx = moderngl.create_standalone_context(**kwargs)
+        except Exception:
+            continue
+        ctx.extra = types.SimpleNamespace()
+        return ctx
+    return None
+
+@functools.lru_cache()
+def get_cells(count=1000):
+    """Cells on and near the track"""
+    track = get_track()
+    rng = random.Random(0)
+    cells = []
+    while len(cells) < count:
+        x = rng.randrange(-track.start_x, track.width - track.start_x)
+        y = rng.randrange(-track.start_y, track.height - track.start_y)
+        if track.nearest_on_track(x, y) is not None:
+            cells.append((x, y))
+    return cells
+
+def make_car(velocity):
+    """Car on a fresh track, at the start, going at `velocity`"""
+    track = Track(LEVEL)
+    car = RacingCar(track, (0, 0))
+    car.velocity = velocity
+    return car
+
+@case('track.get_pixel')
+def bench_get_pixel():
+    track = get_track()
+    cells = get_cells()
+    def run():
+        for x, y in cells:
+            track.get_pixel(x, y)
+    return run
+
+@case('track.is_on_track')
+def bench_is_on_track():
+    track = get_track()
+    cells = get_cells()
+    def run():
+        for x, y in cells:
+            track.is_on_track(x, y)
+    return run
+
+@case('track.x_intersection_passable')
+def bench_x_passable():
+    track = get_track()
+    cells = get_cells()
+    def run():
+        for x, y in cells:
+            track.x_intersection_passable(x + 0.3, y)
+    return run
+
+@case('track.y_intersection_passable')
+def bench_y_passable():
+    track = get_track()
+    cells = get_cells()
+    def run():
+        for x, y in cells:
+            track.y_intersection_passable(x, y + 0.3)
+    return run
+
+@case('car.blocker_on_path_to (slow)')
+def bench_blocker_slow():
+    car = make_car((0, 1))
+    def run():
+        for dx in -1, 0, 1:
+            for dy in -1, 0, 1:
+                car.blocker_on_path_to(dx, dy)
+    return run
+
+@case('car.blocker_on_path_to (fast)')
+def bench_blocker_fast():
+    car = make_car((0, 12))
+    def run():
+        for dx in -1, 0, 1:
+            for dy in -1, 0, 1:
+                car.blocker_on_path_to(dx, dy)
+    return run
+
+@case('car.find_respawn_pos')
+def bench_find_respawn_pos():
+    car = make_car((0, 1))
+    track = car.track
+    blockers = [
+        (x, y, 0.5) for x, y in get_cells(200)
+        if not track.is_on_track(x, y)
+    ]
+    def run():
+        for blocker in blockers:
+            car.find_respawn_pos(blocker)
+    return run
+
+def make_text(ctx, chars):
+    from keypad_racer.text import Text
+    return Text(ctx, chars, scale=0.5, align=1)
+
+SHORT_TEXT = 'Lap: 3'
+LONG_TEXT = '\n'.join(
+    f'Lap {n}: {n}:{n*7 % 60:02}.{n % 10}' for n in range(1, 40)
+)
+
+@case('text.get_vertices (short)', needs_gl=True)
+def bench_text_short():
+    text = make_text(get_ctx(), SHORT_TEXT)
+    return functools.partial(text.get_vertices, SHORT_TEXT)
+
+@case('text.get_vertices (long)', needs_gl=True)
+def bench_text_long():
+    text = make_text(get_ctx(), SHORT_TEXT)
+    return functools.partial(text.get_vertices, LONG_TEXT)
+
+@case('font loading', needs_gl=True)
+def bench_font():
+    from keypad_racer.text import Font
+    ctx = get_ctx()
+    def run():
+        Font(ctx, 'font.png').texture.release()
+    return run
+
+@case('car_group.update (1000 cars, 50 moved)', needs_gl=True)
+def bench_car_group_update():
+    from keypad_racer.circuit import Circuit
+    from keypad_racer.car import CarGroup, Car
+    ctx = get_ctx()
+    group = CarGroup(ctx, Circuit(ctx, LEVEL))
+    cars = [Car(group, (1, 0, 0), pos) for pos in get_cells(1000)]
+    group.update()
+    def run():
+        for car in cars[::20]:
+            car.dirty = True
+        group.update()
+    return run
+
+@case('resources.get_shader')
+def bench_get_shader():
+    names = [
+        f'shaders/{path.name}'
+        for path in (ROOT / 'keypad_racer' / 'shaders').iterdir()
+        if path.suffix in ('.vert', '.frag', '.geom')
+    ]
+    def run():
+        for name in names:
+            resources.get_shader(name)
+    return run
+
+@case('bezier.subdivide')
+def bench_bezier():
+    from bezier import Bezier
+    points = (0, 0), (10.2, 3.1), (20.7, -5.3), (30.1, 7.9)
+    def run():
+        coro = Bezier(*points).subdivide()
+        try:
+            while True:
+                coro.send(None)
+        except StopIteration:
+            pass
+    return run
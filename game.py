@@ -10,6 +10,7 @@ try:
     import moderngl
     import pyglet
     import png
+    import numpy
 except ImportError:
     print(file=sys.stderr)
     print('You need to install dependencies for this game:', file=sys.stderr)
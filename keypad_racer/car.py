@@ -1,39 +1,182 @@
-import struct
 import math
 import time
 
+import numpy
 import pyglet
 
 from . import resources
 from .anim import AnimatedValue, ConstantValue, Wait, Blocker, fork
+from .physics import RacingCar, ACTION_DIRECTIONS
+from . import ghost
+from . import replay
 
-CAR_FORMAT = '=4h2e3e'
-STRIDE = struct.calcsize(CAR_FORMAT)
-
+# Default number of points in a car's trail
 HISTORY_SIZE = 6
-LINE_FORMAT = '=2h'
-LINE_STRIDE = struct.calcsize(LINE_FORMAT)
-
-ACTION_DIRECTIONS = {
-    0: (-1, -1),
-    1: ( 0, -1),
-    2: (+1, -1),
-    3: (-1,  0),
-    4: ( 0,  0),
-    5: (+1,  0),
-    6: (-1, +1),
-    7: ( 0, +1),
-    8: (+1, +1),
-}
-
-explode_sound = pyglet.media.load(resources.global_fspath('sound/acid6.wav'), streaming=False)
+
+# Opacity of ghost cars
+GHOST_ALPHA = 0.35
+
+_explode_sound = None
+
+def get_explode_sound():
+    global _explode_sound
+    if _explode_sound is None:
+        _explode_sound = pyglet.media.load(
+            resources.global_fspath('sound/acid6.wav'), streaming=False,
+        )
+    return _explode_sound
+
+def get_trail_length(track, spec):
+    """Parse a trail length: a number of points, or "lap" for a whole lap
+
+    Trails have at least 2 points. For invalid values, this prints
+    a warning and returns HISTORY_SIZE.
+    """
+    spec = str(spec).strip()
+    if spec == 'lap':
+        # At least one cell per move
+        return max(math.ceil(track.lap_length or HISTORY_SIZE), 2)
+    try:
+        length = int(spec)
+    except ValueError:
+        length = 0
+    if length < 2:
+        print(f'Bad trail length {spec!r} (need 2 or more, or "lap"); '
+              + f'using {HISTORY_SIZE}')
+        return HISTORY_SIZE
+    return length
+
+class DirtyArray:
+    """NumPy array mirrored on the GPU
+
+    Rows are changed with `set_rows`; `upload` then sends all rows between
+    the first and last changed one, in a single write.
+    Setting rows past the end grows the array (at least doubling it).
+
+    Subclasses keep the GPU copy: they implement `write_rows(start, rows)`
+    and `resize_storage()` (after which everything is uploaded again).
+    """
+    def __init__(self, capacity, row_shape, dtype):
+        self.data = numpy.zeros((capacity, *row_shape), dtype)
+        self.dirty_start = capacity
+        self.dirty_end = 0
+
+    def set_rows(self, indices, values):
+        end = max(indices) + 1
+        if end > len(self.data):
+            self.grow(end)
+        self.data[indices] = values
+        self.dirty_start = min(self.dirty_start, min(indices))
+        self.dirty_end = max(self.dirty_end, end)
+
+    def grow(self, size):
+        old_size = len(self.data)
+        data = numpy.zeros(
+            (max(size, old_size * 2), *self.data.shape[1:]), self.data.dtype,
+        )
+        data[:old_size] = self.data
+        self.data = data
+        self.resize_storage()
+        self.dirty_start = 0
+        self.dirty_end = max(self.dirty_end, old_size)
+
+    def upload(self):
+        if self.dirty_start < self.dirty_end:
+            self.write_rows(
+                self.dirty_start, self.data[self.dirty_start:self.dirty_end],
+            )
+        self.dirty_start = len(self.data)
+        self.dirty_end = 0
+
+class BufferArray(DirtyArray):
+    """DirtyArray mirrored in a buffer (for instanced attributes)"""
+    def __init__(self, ctx, capacity, row_shape, dtype):
+        super().__init__(capacity, row_shape, dtype)
+        self.buffer = ctx.buffer(self.data, dynamic=True)
+
+    def resize_storage(self):
+        # Same buffer object, so vertex arrays that use it stay valid
+        self.buffer.orphan(self.data.nbytes)
+
+    def write_rows(self, start, rows):
+        self.buffer.write(rows, offset=start * rows[0].nbytes)
+
+class TrailRing:
+    """Trail points of all instances, in ring buffers on the GPU
+
+    Row i of the texture is the ring of instance i: point number n
+    (counting all points pushed for the instance) is in column n % size.
+    Each point is written once, when it's pushed; which points are drawn
+    is given by per-instance numbers (see Car.trail_start).
+    """
+    def __init__(self, ctx, capacity, size):
+        self.ctx = ctx
+        self.size = size
+        self.rows = capacity
+        self.texture = self.make_texture()
+        # (instance, column, point) not uploaded yet
+        self.pending = []
+
+    def make_texture(self, data=None):
+        texture = self.ctx.texture(
+            (self.size, self.rows), 2, data, dtype='i2',
+        )
+        texture.filter = self.ctx.NEAREST, self.ctx.NEAREST
+        return texture
+
+    def push(self, instance, number, point):
+        """Set point number `number` of an instance"""
+        self.pending.append((instance, number % self.size, point))
+
+    def upload(self):
+        if not self.pending:
+            return
+        needed = max(instance for instance, column, point in self.pending) + 1
+        if needed > self.rows:
+            self.grow(needed)
+        for instance, column, point in self.pending:
+            self.texture.write(
+                numpy.array(point, 'i2'), viewport=(column, instance, 1, 1),
+            )
+        self.pending = []
+
+    def grow(self, rows):
+        old = self.texture
+        old_rows = self.rows
+        self.rows = max(rows, self.rows * 2)
+        data = numpy.zeros((self.rows, self.size, 2), 'i2')
+        data[:old_rows] = numpy.frombuffer(
+            old.read(), 'i2',
+        ).reshape(old_rows, self.size, 2)
+        self.texture = self.make_texture(data)
+        old.release()
 
 class CarGroup:
-    def __init__(self, ctx, circuit, max_cars=9):
+    """Cars (and ghosts) drawn together, with instanced rendering
+
+    Each car or ghost is an instance. Per-instance data is kept in arrays
+    that grow as needed; `capacity` is only the initial size.
+    trail_length is the number of points in the cars' trails.
+    Only cars whose state changed are looked at each frame (see Car.dirty),
+    and move animations run on the GPU, so the per-frame cost doesn't grow
+    with the number of cars standing still.
+    """
+    def __init__(self, ctx, circuit, capacity=16, trail_length=HISTORY_SIZE):
         self.ctx = ctx
         self.circuit = circuit
-        self.max_cars = max_cars
+        self.trail_length = trail_length
         self.cars = []
+        self.ghosts = []
+        self.instance_count = 0
+        self.dirty_cars = []
+        # Animations are timed relative to this (float32 on the GPU)
+        self.start_time = time.monotonic()
+        # ReplayWriter for the race, or None
+        self.recorder = None
+        # For network races: the net.NetworkLink, and the race time (in ms)
+        # of the last action from the server
+        self.link = None
+        self.race_time = None
 
         uv_vertices = bytes((
             1, 255,
@@ -48,14 +191,29 @@ class CarGroup:
             fragment_shader=resources.get_shader('shaders/car.frag'),
         )
 
-        self.cars_vbo = ctx.buffer(bytes(STRIDE * max_cars), dynamic=True)
-        self.t_vbo = ctx.buffer(bytes(max_cars), dynamic=True)
+        # Per-instance data, one array per attribute
+        # Position & position before the last move
+        self.positions = BufferArray(ctx, capacity, (4,), 'i2')
+        # Orientation & orientation before the last move
+        self.orientations = BufferArray(ctx, capacity, (2,), 'f2')
+        self.colors = BufferArray(ctx, capacity, (4,), 'f2')
+        # Move animation (see anim_params)
+        self.anims = BufferArray(ctx, capacity, (4,), 'f4')
+        # Number of the first and after-last trail point (see TrailRing)
+        self.trails = BufferArray(ctx, capacity, (2,), 'i4')
+        self.instance_arrays = [
+            self.positions, self.orientations, self.colors, self.anims,
+            self.trails,
+        ]
+        self.trail_ring = TrailRing(ctx, capacity, trail_length)
         self.vao = ctx.vertex_array(
             self.car_prog,
             [
                 (uv_vbo, '2i1', 'uv'),
-                (self.cars_vbo, '4i2 2f2 3f2 /i', 'pos', 'orientation', 'color'),
-                (self.t_vbo, '1f1 /i', 'pos_t'),
+                (self.positions.buffer, '4i2 /i', 'pos'),
+                (self.orientations.buffer, '2f2 /i', 'orientation'),
+                (self.colors.buffer, '4f2 /i', 'color'),
+                (self.anims.buffer, '4f /i', 'anim'),
             ],
         )
 
@@ -64,21 +222,14 @@ class CarGroup:
             fragment_shader=resources.get_shader('shaders/car_line.frag'),
             geometry_shader=resources.get_shader('shaders/car_line.geom'),
         )
-        self.line_vbo = ctx.buffer(
-            bytes(LINE_STRIDE * max_cars * (HISTORY_SIZE+2)),
-            dynamic=True,
-        )
-        line_t = ctx.buffer(
-            bytes([
-                0,
-                *range(HISTORY_SIZE+1),
-            ]) * self.max_cars,
-        )
+        self.line_prog['history'] = 0
+        self.line_prog['trail_length'] = trail_length
         self.line_vao = ctx.vertex_array(
             self.line_prog,
             [
-                (self.line_vbo, '2i2', 'point'),
-                (line_t, 'i1', 't'),
+                (self.colors.buffer, '4f2 /i', 'color'),
+                (self.anims.buffer, '4f /i', 'anim'),
+                (self.trails.buffer, '2i /i', 'trail'),
             ],
             skip_errors=True,
         )
@@ -86,65 +237,148 @@ class CarGroup:
     def draw(self, view):
         self.circuit.draw(view)
         view.setup(self.car_prog, self.line_prog)
-        ts = bytearray()
-        for car in self.cars:
-            car.update_group()
-            ts.append(round(float(car.anim_t)*255))
-        self.t_vbo.write(ts)
-        if self.cars:
-            for i, car in enumerate(self.cars):
-                self.line_prog['color'] = (*car.color, car.anim_t)
-                self.line_vao.render(
-                    self.ctx.LINE_STRIP_ADJACENCY,
-                    first=i*(HISTORY_SIZE+2),
-                    vertices=HISTORY_SIZE+2,
-                )
+        self.update()
+        if self.instance_count:
+            now = time.monotonic() - self.start_time
+            self.car_prog['time'] = now
+            self.line_prog['time'] = now
+            self.trail_ring.texture.use(location=0)
+            self.line_vao.render(
+                self.ctx.LINE_STRIP_ADJACENCY,
+                vertices=self.trail_length+2,
+                instances=self.instance_count,
+            )
             self.vao.render(
                 self.ctx.TRIANGLE_STRIP,
-                instances=len(self.cars),
+                instances=self.instance_count,
+            )
+
+    def update(self):
+        """Upload what changed since the last update
+
+        All views that show the group share the uploaded data, so only
+        the first view drawn in a frame has anything to upload.
+        """
+        dirty_cars, self.dirty_cars = self.dirty_cars, []
+        instances = []
+        rows = []
+        for car in dirty_cars:
+            car.dirty = False
+            instances.append(car.instance)
+            rows.append(car.instance_data())
+            if car.ghost and (ghost_rows := car.ghost.instance_data()):
+                instances.append(car.ghost.instance)
+                rows.append(ghost_rows)
+        if instances:
+            # One NumPy assignment per array
+            for array, values in zip(self.instance_arrays, zip(*rows)):
+                array.set_rows(instances, values)
+        for array in self.instance_arrays:
+            array.upload()
+        self.trail_ring.upload()
+
+    def anim_params(self, anim_t):
+        """Return a move animation as the shaders need it
+
+        That's the start time, duration, start and end value.
+        (Cars' animations are linear; see Car.move.)
+        """
+        if isinstance(anim_t, AnimatedValue):
+            return (
+                anim_t.begin - self.start_time, anim_t.duration,
+                float(anim_t.start), anim_t.end,
             )
+        value = float(anim_t)
+        return 0, 1, value, value
+
+    def add_instance(self):
+        self.instance_count += 1
+        return self.instance_count - 1
 
     def add_car(self, car):
-        result = len(self.cars)
-        if result > self.max_cars:
-            raise ValueError('Too many cars in group')
         self.cars.append(car)
-        return result
+        return len(self.cars) - 1
 
-class Car:
+    def add_ghost(self, ghost):
+        ghost.instance = self.add_instance()
+        self.ghosts.append(ghost)
+        # The ghost is updated with its car
+        ghost.car.dirty = True
+
+class Car(RacingCar):
     def __init__(self, group, color, pos):
         self.group = group
         self.index = group.add_car(self)
+        self.instance = group.add_instance()
+        self._dirty = False
         self._color = color
         self._orientation = 0
         self.last_orientation = 0
-        self._pos = pos
-        self.last_pos = pos
-        self.history = [struct.pack(LINE_FORMAT, *pos)] * (HISTORY_SIZE+2)
-        self.velocity = 0, 1
+        # Where the car is drawn. After a crash, this stays at the crash
+        # site until the animation is done.
+        self.drawn_pos = pos
+        self.drawn_last_pos = pos
+        # Trail points are pushed to the group's TrailRing; the trail is
+        # the points numbered from trail_start to trail_head (excluding)
+        self.trail_start = self.trail_head = 0
+        self.push_history(pos)
         self.dirty = True
         self.anim_t = ConstantValue(0)
-        self.view_rect = self.get_view_rect()
         self.keypad = None
         self.crashed = False
         self.crash_callback = None
-        self.group.circuit.cars.append(self)
-        self.lap = 1
-        self.max_lap = 1
+        # For network races (see is_standing)
+        self.action_pending = False
+        self.standing_time = math.inf
+        super().__init__(group.circuit, pos)
+        self.view_rect = self.get_view_rect()
         self.lap_start_time = time.monotonic()
         self.lap_times = []
-        self.crash_count = 0
+        # Positions in the current lap (see ghost.py)
+        self.lap_trace = [pos]
+        # Where to save the best lap (or None), the best lap, and its ghost
+        self.best_lap_path = None
+        self.best_lap = None
+        self.ghost = None
 
-    def update_group(self):
-        if not self.dirty:
-            return
-        data = struct.pack(
-            CAR_FORMAT,
-            *self._pos, *self.last_pos, self.orientation, self.last_orientation, *self.color,
+    def load_best_lap(self, path):
+        """Set where to keep the best lap, and show it as a ghost"""
+        self.best_lap_path = path
+        self.best_lap = ghost.load_lap(path)
+        if self.best_lap:
+            self.ghost = Ghost(self, self.best_lap)
+            self.group.add_ghost(self.ghost)
+
+    def instance_data(self):
+        """Return rows for CarGroup.instance_arrays"""
+        return (
+            (*self.drawn_pos, *self.drawn_last_pos),
+            (self.orientation, self.last_orientation),
+            (*self.color, 1),
+            self.group.anim_params(self.anim_t),
+            (self.trail_start, self.trail_head),
         )
-        self.group.cars_vbo.write(data, offset = STRIDE*self.index)
-        data = b''.join(self.history)
-        self.group.line_vbo.write(data, offset=LINE_STRIDE*(HISTORY_SIZE+2)*self.index)
+
+    @property
+    def dirty(self):
+        """True if the car needs to be drawn differently
+
+        Dirty cars are updated on the GPU before the next draw.
+        """
+        return self._dirty
+    @dirty.setter
+    def dirty(self, new):
+        if new and not self._dirty:
+            self.group.dirty_cars.append(self)
+        self._dirty = new
+
+    @property
+    def anim_t(self):
+        return self._anim_t
+    @anim_t.setter
+    def anim_t(self, new):
+        self._anim_t = new
+        self.dirty = True
 
     @property
     def color(self):
@@ -162,45 +396,51 @@ class Car:
         self._orientation = new
         self.dirty = True
 
-    @property
-    def pos(self):
-        return self._pos
+    def is_standing(self):
+        if self.group.race_time is not None:
+            # In network races, all clients must agree on this
+            return self.group.race_time > self.standing_time
+        return float(self.anim_t) > 0.99
+
+    def on_new_lap(self):
+        new_start = time.monotonic()
+        self.lap_times.append(new_start - self.lap_start_time)
+        self.lap_start_time = new_start
+        # Called from RacingCar.move; self.pos is the position after the move
+        trace = [*self.lap_trace, self.pos]
+        self.lap_trace = []
+        if self.best_lap_path and (
+            self.best_lap is None or len(trace) < len(self.best_lap)
+        ):
+            self.best_lap = trace
+            ghost.save_lap(self.best_lap_path, trace)
+            if self.ghost:
+                self.ghost.trace = trace
+            else:
+                self.ghost = Ghost(self, trace)
+                self.group.add_ghost(self.ghost)
+
     def move(self, dx, dy, sound=True):
         duration = 0.5
         self.last_orientation = self._orientation
-        x, y = self.last_pos = self.pos
-        vx, vy = self.velocity
-        vx += dx
-        vy += dy
-        new = x + vx, y + vy
-        final_pos = new
-        blocker = None
+        x, y = self.drawn_last_pos = self.pos
+        new, blocker = super().move(dx, dy)
+        self.lap_trace.append(self.pos)
+        self.standing_time = replay.standing_time(
+            self.group.race_time or 0, (x, y) != new, blocker,
+        )
+        vx = new[0] - x
+        vy = new[1] - y
         dest_t = 1
-        if (vx or vy) and not self.group.circuit.is_on_track(*new):
-            blocker = self.blocker_on_path_to(dx, dy)
-            if blocker:
-                dest_t = blocker[2]
-                respawn_pos = self.find_respawn_pos(blocker)
-                final_pos = respawn_pos
-        self.velocity = vx, vy
-        buf = struct.pack(LINE_FORMAT, *new)
-        self.history = [
-            self.history[2],
-            *self.history[2:-1],
-            buf,
-            buf,
-        ]
-        if self._pos != new:
-            self.last_orientation %= math.tau
-            orient = -math.atan2(vx, vy)
-            orientations = [orient - math.tau, orient, orient + math.tau]
-            self._orientation = min(
-                orientations,
-                key=lambda o: abs(o - self.last_orientation),
-            )
-            self._pos = new
+        if blocker:
+            dest_t = blocker[2]
+            respawn_pos = self.pos
+        self.push_history(new)
+        if (x, y) != new:
+            self.turn_towards(vx, vy)
         else:
             duration /= 2
+        self.drawn_pos = new
         self.dirty = True
         self.anim_t = AnimatedValue(ConstantValue(0), dest_t, duration*dest_t)
         if sound:
@@ -210,16 +450,13 @@ class Car:
         else:
             waitblock = Blocker()
             self.crashed = True
-            self.crash_count += 1
             if self.crash_callback:
                 self.crash_callback()
             @fork
             async def complete_move():
                 await Wait(duration*dest_t)
-                self.velocity = 0, 0
-                self._pos = self.last_pos = respawn_pos
-                self.history = [
-                    struct.pack(LINE_FORMAT, *self.pos)] * (HISTORY_SIZE+2)
+                self.drawn_pos = self.drawn_last_pos = respawn_pos
+                self.reset_history(respawn_pos)
                 self.dirty = True
                 self.view_rect = self.get_view_rect()
                 @fork
@@ -237,21 +474,46 @@ class Car:
         self.view_rect = self.get_view_rect()
         if self.keypad:
             self.keypad.pause(waitblock)
-        x, y = final_pos
-        if x < 20:
-            lx, ly = self.last_pos
-            if (y < 0) != (ly < 0):
-                if y < 0:
-                    self.lap -= 1
-                else:
-                    self.lap += 1
-                if self.lap > self.max_lap:
-                    self.max_lap = self.lap
-                    new_start = time.monotonic()
-                    self.lap_times.append(new_start - self.lap_start_time)
-                    self.lap_start_time = new_start
         return duration
 
+    def load_state(self, state):
+        """Jump to a state from ReplayCar.get_state, without animation"""
+        (
+            x, y, last_x, last_y, vx, vy,
+            self.lap, self.max_lap, self.crash_count, turns,
+            self.track_progress, self.standing_time,
+        ) = state
+        self.pos = self.drawn_pos = self.drawn_last_pos = x, y
+        self.last_pos = last_x, last_y
+        self.velocity = vx, vy
+        if (vx, vy) != (0, 0):
+            self.turn_towards(vx, vy)
+            self.last_orientation = self._orientation
+        self.lap_trace = [(x, y)]
+        self.reset_history((x, y))
+        self.anim_t = ConstantValue(1)
+        self.view_rect = self.get_view_rect()
+
+    def push_history(self, pos):
+        self.group.trail_ring.push(self.instance, self.trail_head, pos)
+        self.trail_head += 1
+        self.dirty = True
+
+    def reset_history(self, pos):
+        """Start a new trail at pos"""
+        self.trail_start = self.trail_head
+        self.push_history(pos)
+
+    def turn_towards(self, vx, vy):
+        """Set orientation to (vx, vy), turning the shorter way"""
+        self.last_orientation %= math.tau
+        orient = -math.atan2(vx, vy)
+        orientations = [orient - math.tau, orient, orient + math.tau]
+        self._orientation = min(
+            orientations,
+            key=lambda o: abs(o - self.last_orientation),
+        )
+
     def play_sounds(self, vx, vy, duration, dest_t, crash=False):
       try:
         best = max(abs(vx), abs(vy))
@@ -274,48 +536,28 @@ class Car:
             pyglet.clock.schedule_once(_play, t*duration)
         if crash:
             def _play(dt):
-                explode_sound.play()
+                get_explode_sound().play()
             pyglet.clock.schedule_once(_play, dest_t*duration)
       except Exception:
           # XXX
           pass
 
-    @property
-    def speed(self):
-        return math.sqrt(self.velocity[0]**2 + self.velocity[1]**2)
-
-    def find_respawn_pos(self, blocker):
-        bx, by, t = blocker
-        bx = round(bx)
-        by = round(by)
-        circuit = self.group.circuit
-        for i in range(100):
-            positions = [
-                *((bx+i, y) for y in range(by-i, by+i+1)),
-                *((bx-i, y) for y in range(by-i, by+i+1)),
-                *((x, by-i) for x in range(bx-i, bx+i+1)),
-                *((x, by+i) for x in range(bx-i, bx+i+1)),
-            ]
-            positions = [p for p in positions if circuit.is_on_track(*p)]
-            if positions:
-                return min(
-                    positions,
-                    key=lambda p: (p[0]-bx)**2 + (p[1]-by)**2,
-                )
-        # !?
-        print('No respawn point found...?!')
-        return bx, by
-
     def act(self, action):
         if (xy := ACTION_DIRECTIONS.get(action)):
+            if self.group.link:
+                # The car moves when the server sends the action back
+                if not self.action_pending:
+                    self.action_pending = True
+                    self.group.link.send(self.index, action)
+                return 0
+            if self.group.recorder:
+                self.group.recorder.record(self.index, action)
             return self.move(*xy)
         return 0
 
     def get_view_rect(self):
-        x, y = self.pos
-        x1, y1 = self.pos
-        x2, y2 = self.pos
-        x3, y3 = self.pos
+        x, y = self.drawn_pos
+        x1, y1 = self.drawn_pos
         dx, dy = self.velocity
         for dx2 in range(abs(dx)):
             x1 += dx
@@ -328,50 +570,37 @@ class Car:
             max(y, y1, y + dy, y - dy) + 5,
         )
 
-    def blocker_on_direction(self, direction):
-        if (xy := ACTION_DIRECTIONS.get(direction)):
-            return self.blocker_on_path_to(*xy)
-        return None
-
-    def blocker_on_path_to(self, x, y):
-        crash_ts = []
-        circuit = self.group.circuit
-        sx, sy = self.pos
-        vx, vy = self.velocity
-        dest_x = sx + vx + x
-        dest_y = sy + vy + y
-        xrange = abs(sx - dest_x)
-        if xrange:
-            for t in range(xrange + 1):
-                t /= xrange
-                x = (1-t) * sx + t * dest_x
-                y = (1-t) * sy + t * dest_y
-                ok = circuit.y_intersection_passable(round(x), y);
-                if not ok:
-                    crash_ts.append(t)
-                    break
-
-        yrange = abs(sy - dest_y)
-        if yrange:
-            for t in range(yrange + 1):
-                t /= yrange
-                x = (1-t) * sx + t * dest_x
-                y = (1-t) * sy + t * dest_y
-                ok = circuit.x_intersection_passable(x, round(y))
-                if not ok:
-                    crash_ts.append(t)
-                    break
-        if not circuit.is_on_track(dest_x, dest_y):
-            crash_ts.append(1)
-
-        if crash_ts:
-            t = min(crash_ts)
-            x = (1-t) * sx + t * dest_x
-            y = (1-t) * sy + t * dest_y
-            return x, y, t
-        return None
-
-
-def _all(a, b):
-    a, b = sorted((a, b))
-    return range(math.floor(a), math.ceil(b)+1)
+class Ghost:
+    """A recorded lap, drawn in step with a car's current lap
+
+    The ghost is where the car would be if it drove the recorded lap:
+    after N turns of the car's lap, it's at the N-th position of the trace.
+    It isn't on the circuit, so it doesn't block anyone.
+    """
+    def __init__(self, car, trace):
+        self.car = car
+        self.trace = trace
+        # Set by CarGroup.add_ghost
+        self.instance = None
+        self._drawn = None
+
+    def instance_data(self):
+        """Return rows for CarGroup.instance_arrays, or None if unchanged"""
+        turn = min(len(self.car.lap_trace) - 1, len(self.trace) - 1)
+        state = turn, self.trace, self.car.color, self.car.anim_t
+        if state == self._drawn:
+            return None
+        self._drawn = state
+        pos = self.trace[turn]
+        last_pos = self.trace[max(turn - 1, 0)]
+        vx = pos[0] - last_pos[0]
+        vy = pos[1] - last_pos[1]
+        orientation = -math.atan2(vx, vy) if (vx or vy) else 0
+        return (
+            (*pos, *last_pos),
+            (orientation, orientation),
+            (*self.car.color, GHOST_ALPHA),
+            self.car.group.anim_params(self.car.anim_t),
+            # Ghosts have no trail (see car_line.geom)
+            (0, 0),
+        )
@@ -1,50 +1,65 @@
-from pathlib import Path
+import collections
+import weakref
 import struct
-import sys
-import zlib
 import math
 
-import png
+import numpy
 
 from . import resources
+from .physics import Track
+from .tiles import TILE_SIZE, TILE_SHIFT
 
-class Circuit:
+# The atlas of tiles on the GPU has ATLAS_SLOTS×ATLAS_SLOTS tiles
+ATLAS_SLOTS = 32
+
+# Rails are drawn (and culled) in chunks of this many points
+RAIL_CHUNK_POINTS = 64
+# Index that starts a new line strip
+RESTART_INDEX = 0xFFFFFFFF
+RAIL_COLOR = 0xff, 0xff, 0xff, 0x38
+
+# Views are drawn from a cache of rendered tiles, CACHE_TILE_SIZE px square
+# plus a 1px border (so CACHE_SLOT_SIZE px in the cache texture).
+CACHE_TILE_SIZE = 128
+CACHE_SLOT_SIZE = CACHE_TILE_SIZE + 2
+# Tiles are rendered at 2**band px per cell; bands above this would
+# need lots of tiles for a few cells
+MAX_BAND = 9
+
+class Circuit(Track):
+    """Track that can draw itself
+
+    The grid and rails are rendered into a cache of world-space tiles,
+    for each zoom band (power-of-two px per cell) that's in use, and views
+    are composited from the cache. The cache stays valid as long as the
+    circuit does; a new level gets a new Circuit.
+    """
     def __init__(self, ctx, path):
+        super().__init__(path)
         self.ctx = ctx
-        self.cars = []
-        path = Path(path).resolve()
-        intersection_data = bytearray()
-        with path.open('rb') as f:
-            width, height, rows, info = png.Reader(file=f).asRGBA8()
-            self.width = width
-            self.height = height
-            for row in reversed(list(rows)):
-                intersection_data.extend(row)
-        self.intersection_data = intersection_data
-
-        # Get start point and rail coordinates from custom chunks
-        start_x = start_y = 0
-        rail_data = bytearray()
-        self.rail_pieces = []
-        with path.open('rb') as f:
-            for chunk_type, content in png.Reader(file=f).chunks():
-                if chunk_type == b'stRt':
-                    start_x, start_y = struct.unpack('<ii', content)
-                if chunk_type == b'raIl':
-                    content = zlib.decompress(content)
-                    # Rail coords are 2f2; 4 bytes in total.
-                    self.rail_pieces.append((len(rail_data)//4, len(content)//4))
-                    rail_data.extend(content)
-        if sys.byteorder != 'little':
-            # Byte-swap... hope it works, not tested on actual big endians
-            rail_data[0::2], rail_data[1::2] = rail_data[1::2], rail_data[0::2]
-
-        self.intersection_tex = ctx.texture(
-            (width, height), 4, intersection_data,
+        start_x, start_y = self.start_x, self.start_y
+
+        # Intersection data is streamed to the GPU tile by tile, as views
+        # need them. The page table has the atlas slot of each grid tile;
+        # slot 0 is the empty tile.
+        tiles_high, tiles_wide = self.grid.tile_table.shape
+        self.page_table = ctx.texture((tiles_wide, tiles_high), 1, dtype='u2')
+        self.page_table.write(bytes(tiles_wide * tiles_high * 2))
+        self.tile_atlas = ctx.texture((ATLAS_SLOTS * TILE_SIZE,) * 2, 4)
+        self.tile_atlas.write(
+            bytes(TILE_SIZE * TILE_SIZE * 4),
+            viewport=(0, 0, TILE_SIZE, TILE_SIZE),
         )
+        for texture in self.page_table, self.tile_atlas:
+            texture.filter = ctx.NEAREST, ctx.NEAREST
+        # Grid tile -> atlas slot; least recently used first
+        self.resident_tiles = collections.OrderedDict()
+        self.free_slots = list(range(ATLAS_SLOTS ** 2 - 1, 0, -1))
 
-        if not rail_data:
-            rail_data.append(0)
+        # Rail coords are 2f2
+        rail_data = self.rail_data.astype('=f2', copy=False)
+        if not rail_data.size:
+            rail_data = bytes(1)
 
         uv_vertices = bytes((
             1, 255,
@@ -58,7 +73,10 @@ class Circuit:
             vertex_shader=resources.get_shader('shaders/grid.vert'),
             fragment_shader=resources.get_shader('shaders/grid.frag'),
         )
-        self.grid_prog['intersections_tex'] = 0
+        self.grid_prog['page_table'] = 0
+        self.grid_prog['tile_atlas'] = 1
+        self.grid_prog['tile_size'] = TILE_SIZE
+        self.grid_prog['atlas_slots'] = ATLAS_SLOTS
         self.grid_prog['grid_origin'] = start_x, start_y
         self.grid_vao = ctx.vertex_array(
             self.grid_prog,
@@ -68,6 +86,15 @@ class Circuit:
         )
 
         rail_vbo = ctx.buffer(rail_data)
+        self.rail_indices, self.rail_chunk_ends, self.rail_boxes = (
+            rail_chunks(self.rail_data, self.rail_pieces)
+        )
+        self.rail_boxes -= (start_x, start_y, start_x, start_y)
+        self.rail_ibo = ctx.buffer(reserve=max(self.rail_indices.nbytes, 4))
+        self.rail_ibo.write(self.rail_indices)
+        self.rail_index_count = len(self.rail_indices)
+        # Chunks currently in the index buffer
+        self.rail_visible = numpy.ones(len(self.rail_boxes), bool)
         self.rail_prog = ctx.program(
             vertex_shader=resources.get_shader('shaders/rail.vert'),
             geometry_shader=resources.get_shader('shaders/rail.geom'),
@@ -78,54 +105,290 @@ class Circuit:
             self.rail_prog,
             [
                 (rail_vbo, '2f2', 'point'),
-                (ctx.buffer(b'\xff\xff\xff\x38\x00'), '4f1 u1 /i', 'color', 'thickness'),
+                (ctx.buffer(bytes((*RAIL_COLOR, 0))), '4f1 u1 /i', 'color', 'thickness'),
+            ],
+            index_buffer=self.rail_ibo,
+            index_element_size=4,
+        )
+
+        # The tile cache has cache_slots×cache_slots tiles. It's created
+        # (and grown) when views are drawn, for the tiles they need.
+        self.cache_slots = 0
+        self.max_cache_slots = ctx.info['GL_MAX_TEXTURE_SIZE'] // CACHE_SLOT_SIZE
+        self.tile_cache = self.cache_fbo = None
+        # (band, tile_x, tile_y) -> (slot_x, slot_y); least recently used first
+        self.cached_tiles = collections.OrderedDict()
+        self.free_cache_slots = []
+        # Number of tiles each view needed when it was last drawn
+        self.view_tiles = weakref.WeakKeyDictionary()
+        self.composite_prog = ctx.program(
+            vertex_shader=resources.get_shader('shaders/grid_composite.vert'),
+            fragment_shader=resources.get_shader('shaders/grid_composite.frag'),
+        )
+        self.composite_prog['tile_cache'] = 0
+        self.composite_prog['tile_size'] = CACHE_TILE_SIZE
+        self.composite_prog['rail_color'] = tuple(c / 255 for c in RAIL_COLOR)
+        # (tile_x, tile_y, slot_x, slot_y) of each tile to draw, as 4i4
+        self.composite_instances = ctx.buffer(reserve=16, dynamic=True)
+        self.composite_vao = ctx.vertex_array(
+            self.composite_prog,
+            [
+                (ctx.buffer(bytes((0, 0, 1, 0, 0, 1, 1, 1))), '2u1', 'corner'),
+                (self.composite_instances, '2i 2i /i', 'tile', 'slot'),
             ],
         )
-        self.start_x = start_x
-        self.start_y = start_y
 
     def draw(self, view):
-        view.setup(self.grid_prog, self.rail_prog)
-        self.intersection_tex.use(location=0)
-        self.grid_vao.render(
+        x, y, scale_x, scale_y = view.current_params()
+        px_per_cell = view.viewport[2] / (2 * scale_x)
+        band = min(round(math.log2(max(px_per_cell, 1e-6))), MAX_BAND)
+        while True:
+            tiles = visible_cache_tiles(band, view.visible_rect())
+            if len(tiles) <= self.max_cache_slots ** 2:
+                break
+            # Too many tiles for the biggest cache; use larger ones
+            band -= 1
+        self.view_tiles[view] = len(tiles)
+        self.reserve_cache(sum(self.view_tiles.values()))
+        slots = self.cache_tiles(band, tiles)
+        instances = numpy.array(
+            [(*tile, *slot) for tile, slot in zip(tiles, slots)],
+            numpy.int32,
+        )
+        if instances.nbytes > self.composite_instances.size:
+            # Same buffer object, so the vertex array stays valid
+            self.composite_instances.orphan(instances.nbytes * 2)
+        self.composite_instances.write(instances)
+        view.setup(self.composite_prog)
+        self.composite_prog['tile_cells'] = CACHE_TILE_SIZE / 2 ** band
+        self.tile_cache.use(location=0)
+        # Tiles are opaque. Blending costs as much as the shading on
+        # software renderers.
+        self.ctx.disable(self.ctx.BLEND)
+        self.composite_vao.render(
             self.ctx.TRIANGLE_STRIP,
+            instances=len(instances),
         )
-        for start, num in self.rail_pieces:
-            self.rail_vao.render(
-                self.ctx.LINE_STRIP_ADJACENCY,
-                first=start,
-                vertices=num,
-            )
+        self.ctx.enable(self.ctx.BLEND)
+
+    def reserve_cache(self, num_tiles):
+        """Grow the tile cache to fit num_tiles, if the GL limit allows
 
-    def get_pixel(self, x, y):
-        x += self.start_x
-        y += self.start_y
-        if 0 <= x < self.width and 0 <= y < self.height:
-            idx = x*4 + y*4*self.width
-            return self.intersection_data[idx:idx + 4]
-        return b'\0\0\0\0'
-
-    def is_on_track(self, x, y):
-        if not sum(self.get_pixel(x, y)):
-            return False
-        for car in self.cars:
-            if car.pos == (x, y) and float(car.anim_t) > 0.99:
-                return False
-        return True
-
-    def y_intersection_passable(self, x, y):
-        y0 = math.floor(y)
-        rem = y - y0
-        return (
-            rem < self.get_pixel(x, y0)[3]/255
-            or 1-rem < self.get_pixel(x, y0+1)[1]/255
+        Tiles that are in the cache are kept.
+        """
+        if num_tiles <= self.cache_slots ** 2:
+            return
+        # Leave room for zooming and panning
+        slots = min(math.ceil(math.sqrt(num_tiles * 2)), self.max_cache_slots)
+        if slots <= self.cache_slots:
+            return
+        ctx = self.ctx
+        tile_cache = ctx.texture((slots * CACHE_SLOT_SIZE,) * 2, 4)
+        tile_cache.filter = ctx.LINEAR, ctx.LINEAR
+        cache_fbo = ctx.framebuffer(color_attachments=[tile_cache])
+        if self.tile_cache:
+            # Slots are (x, y) positions; the old ones stay where they were
+            # Blits are clipped by the scissor test
+            framebuffer, scissor = ctx.fbo, ctx.scissor
+            ctx.scissor = None
+            ctx.copy_framebuffer(cache_fbo, self.cache_fbo)
+            ctx.scissor = scissor
+            framebuffer.use()
+            self.cache_fbo.release()
+            self.tile_cache.release()
+        old_slots = self.cache_slots
+        self.free_cache_slots.extend(
+            (slot_x, slot_y)
+            # Reversed, so the first slots are used first
+            for slot_y in reversed(range(slots))
+            for slot_x in reversed(range(slots))
+            if slot_x >= old_slots or slot_y >= old_slots
         )
-        return False
-
-    def x_intersection_passable(self, x, y):
-        x0 = math.floor(x)
-        rem = x - x0
-        return (
-            rem < self.get_pixel(x0, y)[2]/255
-            or 1-rem < self.get_pixel(x0+1, y)[0]/255
+        self.tile_cache = tile_cache
+        self.cache_fbo = cache_fbo
+        self.cache_slots = slots
+        self.composite_prog['cache_size'] = slots * CACHE_SLOT_SIZE
+
+    def cache_tiles(self, band, tiles):
+        """Make sure the given (tile_x, tile_y) are in the cache
+
+        Return their cache slots, as (slot_x, slot_y).
+        """
+        slots = []
+        missing = []
+        for tile_x, tile_y in tiles:
+            key = band, tile_x, tile_y
+            slot = self.cached_tiles.get(key)
+            if slot is None:
+                if self.free_cache_slots:
+                    slot = self.free_cache_slots.pop()
+                else:
+                    # This view's tiles were moved to the end, so they
+                    # aren't evicted (the cache has room for them)
+                    oldest, slot = self.cached_tiles.popitem(last=False)
+                missing.append((tile_x, tile_y, slot))
+            self.cached_tiles[key] = slot
+            self.cached_tiles.move_to_end(key)
+            slots.append(slot)
+        if missing:
+            self._render_tiles(band, missing)
+        return slots
+
+    def _render_tiles(self, band, tiles):
+        """Render (tile_x, tile_y, slot) tiles of a band into the cache"""
+        ctx = self.ctx
+        tile_cells = CACHE_TILE_SIZE / 2 ** band
+        size = CACHE_SLOT_SIZE
+        # Half of the tile's size, with the border, in cells
+        half_size = size / 2 / 2 ** band
+        tiles_x, tiles_y, slots = zip(*tiles)
+        self.stream_tiles((
+            min(tiles_x) * tile_cells, min(tiles_y) * tile_cells,
+            (max(tiles_x) + 1) * tile_cells, (max(tiles_y) + 1) * tile_cells,
+        ))
+        self.page_table.use(location=0)
+        self.tile_atlas.use(location=1)
+        tile_params = []
+        for tile_x, tile_y, (slot_x, slot_y) in tiles:
+            tile_params.append((
+                (slot_x * size, slot_y * size, size, size),
+                (
+                    (tile_x + 0.5) * tile_cells, (tile_y + 0.5) * tile_cells,
+                    half_size, half_size,
+                ),
+            ))
+        framebuffer = ctx.fbo
+        self.cache_fbo.use()
+        ctx.blend_func = ctx.ONE, ctx.ZERO
+        for viewport, params in tile_params:
+            ctx.viewport = ctx.scissor = viewport
+            self.grid_prog['viewport'] = viewport
+            self.grid_prog['projection_params'] = params
+            self.grid_vao.render(ctx.TRIANGLE_STRIP)
+        # Rails go in the alpha channel, drawn over each other
+        ctx.blend_func = ctx.ZERO, ctx.ONE, ctx.ONE, ctx.ONE_MINUS_SRC_ALPHA
+        for viewport, (x, y, scale_x, scale_y) in tile_params:
+            self.cull_rails((x - scale_x, y - scale_y, x + scale_x, y + scale_y))
+            if self.rail_index_count:
+                ctx.viewport = ctx.scissor = viewport
+                self.rail_prog['viewport'] = viewport
+                self.rail_prog['projection_params'] = x, y, scale_x, scale_y
+                self.rail_vao.render(
+                    ctx.LINE_STRIP_ADJACENCY,
+                    vertices=self.rail_index_count,
+                )
+        ctx.blend_func = ctx.SRC_ALPHA, ctx.ONE_MINUS_SRC_ALPHA
+        framebuffer.use()
+
+    def cull_rails(self, rect):
+        """Fill the rail index buffer with chunks visible in rect"""
+        x0, y0, x1, y1 = rect
+        boxes = self.rail_boxes
+        visible = (
+            (boxes[:, 0] <= x1) & (boxes[:, 2] >= x0)
+            & (boxes[:, 1] <= y1) & (boxes[:, 3] >= y0)
         )
+        if numpy.array_equal(visible, self.rail_visible):
+            return
+        starts = numpy.concatenate(([0], self.rail_chunk_ends[:-1]))
+        indices = numpy.concatenate([
+            self.rail_indices[start:end]
+            for start, end in zip(starts[visible], self.rail_chunk_ends[visible])
+        ] or [self.rail_indices[:0]])
+        self.rail_visible = visible
+        self.rail_ibo.write(indices)
+        self.rail_index_count = len(indices)
+
+    def stream_tiles(self, rect):
+        """Make sure the tiles visible in rect (x0, y0, x1, y1) are on the GPU
+        """
+        x0, y0, x1, y1 = rect
+        tiles_high, tiles_wide = self.grid.tile_table.shape
+        # The grid shader also looks at neighbouring cells
+        tx0 = max((math.floor(x0) + self.start_x - 1) >> TILE_SHIFT, 0)
+        ty0 = max((math.floor(y0) + self.start_y - 1) >> TILE_SHIFT, 0)
+        tx1 = min((math.ceil(x1) + self.start_x + 1) >> TILE_SHIFT, tiles_wide-1)
+        ty1 = min((math.ceil(y1) + self.start_y + 1) >> TILE_SHIFT, tiles_high-1)
+        visible = self.grid.tile_table[ty0:ty1+1, tx0:tx1+1]
+        used = set()
+        for tile_y, tile_x in numpy.argwhere(visible).tolist():
+            key = tile_y + ty0, tile_x + tx0
+            used.add(key)
+            if key in self.resident_tiles:
+                self.resident_tiles.move_to_end(key)
+                continue
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                oldest = next(iter(self.resident_tiles))
+                if oldest in used:
+                    # The atlas is full of tiles for this view
+                    break
+                slot = self.resident_tiles.pop(oldest)
+                self._set_page(oldest, 0)
+            self.resident_tiles[key] = slot
+            slot_y, slot_x = divmod(slot, ATLAS_SLOTS)
+            self.tile_atlas.write(
+                self.grid.tiles[self.grid.tile_table[key]],
+                viewport=(
+                    slot_x * TILE_SIZE, slot_y * TILE_SIZE,
+                    TILE_SIZE, TILE_SIZE,
+                ),
+            )
+            self._set_page(key, slot)
+
+    def _set_page(self, key, slot):
+        tile_y, tile_x = key
+        self.page_table.write(
+            struct.pack('=H', slot),
+            viewport=(tile_x, tile_y, 1, 1),
+        )
+
+def visible_cache_tiles(band, rect):
+    """Return (tile_x, tile_y) of cache tiles of a band that intersect rect"""
+    tile_cells = CACHE_TILE_SIZE / 2 ** band
+    x0, y0, x1, y1 = (math.floor(c / tile_cells) for c in rect)
+    return [
+        (tile_x, tile_y)
+        for tile_y in range(y0, y1 + 1)
+        for tile_x in range(x0, x1 + 1)
+    ]
+
+def rail_chunks(rail_data, rail_pieces):
+    """Split rail line strips into chunks that can be culled separately
+
+    Returns:
+    - indices: uint32 array of point indices for all chunks; each chunk
+      ends with RESTART_INDEX
+    - chunk_ends: end of each chunk in `indices`
+    - boxes: float array of (x0, y0, x1, y1) bounding boxes of chunks,
+      in grid coordinates
+
+    Consecutive chunks overlap by 3 points, so that each segment is drawn
+    exactly once, with its adjacent points.
+    """
+    points = numpy.asarray(rail_data, numpy.float32)
+    indices = []
+    chunk_ends = []
+    boxes = []
+    for first, count in rail_pieces:
+        if count < 4:
+            # Too short to draw anything
+            continue
+        start = 0
+        while True:
+            end = min(start + RAIL_CHUNK_POINTS, count)
+            indices.extend(range(first + start, first + end))
+            indices.append(RESTART_INDEX)
+            chunk_ends.append(len(indices))
+            chunk = points[first + start:first + end]
+            # The rail has some thickness, keep a margin of one cell
+            boxes.append((*(chunk.min(axis=0) - 1), *(chunk.max(axis=0) + 1)))
+            if end >= count:
+                break
+            start = end - 3
+    return (
+        numpy.array(indices, numpy.uint32),
+        numpy.array(chunk_ends, numpy.intp),
+        numpy.array(boxes, numpy.float32).reshape(-1, 4),
+    )
@@ -0,0 +1,166 @@
+"""Many races at once, for training and evaluating bots
+
+RaceEnv runs a number of independent single-car races on one track.
+All state is kept in NumPy arrays, and `step` moves every car in one call.
+The rules are the same as RacingCar.move (cars in different races don't
+see each other).
+
+    env = RaceEnv(Track('okruh.png'), 1000)
+    obs = env.reset()
+    while not env.done.all():
+        obs, reward, done, crashed = env.step(choose_actions(obs))
+"""
+
+import numpy
+
+from .physics import ACTION_DX, ACTION_DY
+
+class RaceEnv:
+    def __init__(self, track, num_envs, laps=1, pos=(0, 0), velocity=(0, 1)):
+        if track.progress is None:
+            raise ValueError('RaceEnv needs a track with progress data')
+        self.track = track
+        self.num_envs = num_envs
+        self.laps = laps
+        self.start_pos = pos
+        self.start_velocity = velocity
+        self.pos = numpy.zeros((num_envs, 2), numpy.int64)
+        self.velocity = numpy.zeros((num_envs, 2), numpy.int64)
+        self.lap = numpy.zeros(num_envs, numpy.int64)
+        self.progress = numpy.zeros(num_envs)
+        self.turns = numpy.zeros(num_envs, numpy.int64)
+        self.crash_count = numpy.zeros(num_envs, numpy.int64)
+        self.done = numpy.zeros(num_envs, bool)
+        self.reset()
+
+    def reset(self, which=None):
+        """Restart the races selected by `which` (a mask or indices), or all
+
+        Returns the observation (see observe).
+        """
+        if which is None:
+            which = slice(None)
+        self.pos[which] = self.start_pos
+        self.velocity[which] = self.start_velocity
+        self.lap[which] = 1
+        self.progress[which] = self._progress_at(
+            numpy.array([self.start_pos]),
+        )[0]
+        self.turns[which] = 0
+        self.crash_count[which] = 0
+        self.done[which] = False
+        return self.observe()
+
+    def observe(self):
+        """Return a dict of (copies of) the state arrays"""
+        return {
+            'pos': self.pos.copy(),
+            'velocity': self.velocity.copy(),
+            'lap': self.lap.copy(),
+            'progress': self.progress.copy(),
+            'race_distance': self.race_distance(),
+            'turns': self.turns.copy(),
+            'done': self.done.copy(),
+        }
+
+    def race_distance(self):
+        """Distance driven along the track in each race, in cells"""
+        return (self.lap - 1) * self.track.lap_length + self.progress
+
+    def crash_ts(self):
+        """Where each action would crash, for all races; see action_crash_ts"""
+        return self.track.action_crash_ts(
+            self.pos[:, 0], self.pos[:, 1],
+            self.velocity[:, 0], self.velocity[:, 1],
+        )
+
+    def step(self, actions):
+        """Do one turn in all races that aren't done
+
+        `actions` has an action number (0-8, see ACTION_DIRECTIONS) for
+        each race; it's ignored for finished races.
+        Returns (observation, reward, done, crashed), where reward is the
+        race distance gained in this turn, and crashed tells which cars
+        crashed.
+        """
+        track = self.track
+        actions = numpy.asarray(actions)
+        active = ~self.done
+        distance_before = self.race_distance()
+
+        sx, sy = self.pos[active].T
+        vx = self.velocity[active, 0] + ACTION_DX[actions[active]]
+        vy = self.velocity[active, 1] + ACTION_DY[actions[active]]
+        dest_x = sx + vx
+        dest_y = sy + vy
+        # As in RacingCar.move: only moves that end off the track crash
+        crashed = ((vx != 0) | (vy != 0)) & ~track.is_on_track_batch(
+            dest_x, dest_y, check_cars=False,
+        )
+        final_x = dest_x.copy()
+        final_y = dest_y.copy()
+        if crashed.any():
+            t = track.crash_ts_batch(
+                sx[crashed], sy[crashed], dest_x[crashed], dest_y[crashed],
+                check_cars=False,
+            )
+            block_x = numpy.rint((1-t) * sx[crashed] + t * dest_x[crashed])
+            block_y = numpy.rint((1-t) * sy[crashed] + t * dest_y[crashed])
+            final_x[crashed], final_y[crashed] = self._respawn_positions(
+                block_x.astype(numpy.int64), block_y.astype(numpy.int64),
+                sx[crashed], sy[crashed],
+            )
+            vx[crashed] = 0
+            vy[crashed] = 0
+
+        old_progress = self.progress[active]
+        new_progress = self._progress_at(numpy.stack((final_x, final_y), -1))
+        half_lap = track.lap_length / 2
+        lap_change = (
+            (old_progress - new_progress > half_lap).astype(numpy.int64)
+            - (new_progress - old_progress > half_lap)
+        )
+
+        self.pos[active] = numpy.stack((final_x, final_y), -1)
+        self.velocity[active] = numpy.stack((vx, vy), -1)
+        self.progress[active] = new_progress
+        self.lap[active] += lap_change
+        self.turns[active] += 1
+        self.crash_count[active] += crashed
+        all_crashed = numpy.zeros(self.num_envs, bool)
+        all_crashed[active] = crashed
+        self.done |= self.lap > self.laps
+        reward = self.race_distance() - distance_before
+        return self.observe(), reward, self.done.copy(), all_crashed
+
+    def _progress_at(self, pos):
+        track = self.track
+        return track.progress.get_many(
+            pos[:, 0] + track.start_x, pos[:, 1] + track.start_y,
+        ).astype(numpy.float64)
+
+    def _respawn_positions(self, block_x, block_y, own_x, own_y):
+        """Vectorized RacingCar.find_respawn_pos, for cars racing alone
+
+        While the respawn point is searched for, the car is still at its
+        old position, so that cell is not free.
+        """
+        track = self.track
+        near_y, near_x = track.nearest_track_cells.get_many(
+            block_x + track.start_x, block_y + track.start_y,
+        ).T
+        result_x = near_x - track.start_x
+        result_y = near_y - track.start_y
+        unusual = (near_y < 0) | ((result_x == own_x) & (result_y == own_y))
+        # Rare cases are left to the general search
+        for i in numpy.flatnonzero(unusual).tolist():
+            own = int(own_x[i]), int(own_y[i])
+            def is_free(x, y):
+                return track.is_on_track(x, y, check_cars=False) and (x, y) != own
+            if near_y[i] < 0:
+                center = int(block_x[i]), int(block_y[i])
+            else:
+                center = int(result_x[i]), int(result_y[i])
+            found = track.search_free_cell(*center, is_free)
+            result_x[i], result_y[i] = found if found else center
+        return result_x, result_y
@@ -0,0 +1,83 @@
+"""Best-lap traces, for racing against ghost cars
+
+A trace is the list of positions of a car during one lap: where the lap
+started, then the position after each turn.
+Traces are stored per circuit and player, in ghosts/CIRCUIT/PLAYER.krg
+under the user's data directory (see levelfile.data_dir).
+The file has a header, then varints: the number of turns, the start
+position, and the change in position for each turn (all signed values are
+zigzag-encoded).
+"""
+
+from pathlib import Path
+import struct
+import io
+import os
+import re
+
+from .replay import encode_varint, read_varint
+from .levelfile import data_dir
+
+MAGIC = b'KRghost\0'
+VERSION = 1
+HEADER_FORMAT = '<8sI'
+
+def zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def unzigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+def lap_path(level_path, player_name):
+    """Return the path of a player's best lap on a circuit"""
+    slug = re.sub('[^a-z0-9]+', '-', player_name.lower()).strip('-')
+    return data_dir() / 'ghosts' / Path(level_path).stem / (slug + '.krg')
+
+def encode_trace(trace):
+    (x, y), *rest = trace
+    data = bytearray(struct.pack(HEADER_FORMAT, MAGIC, VERSION))
+    data += encode_varint(len(rest))
+    data += encode_varint(zigzag(x)) + encode_varint(zigzag(y))
+    for new_x, new_y in rest:
+        data += encode_varint(zigzag(new_x - x))
+        data += encode_varint(zigzag(new_y - y))
+        x, y = new_x, new_y
+    return bytes(data)
+
+def decode_trace(data):
+    f = io.BytesIO(data)
+    magic, version = struct.unpack(
+        HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)),
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a supported lap trace')
+    turns, x, y = (read_varint(f) for i in range(3))
+    if y is None:
+        raise ValueError('truncated lap trace')
+    x, y = unzigzag(x), unzigzag(y)
+    trace = [(x, y)]
+    for i in range(turns):
+        dx, dy = read_varint(f), read_varint(f)
+        if dy is None:
+            raise ValueError('truncated lap trace')
+        x += unzigzag(dx)
+        y += unzigzag(dy)
+        trace.append((x, y))
+    return trace
+
+def load_lap(path):
+    """Load a lap trace; return None if there's no usable one"""
+    try:
+        return decode_trace(Path(path).read_bytes())
+    except (OSError, ValueError, struct.error):
+        return None
+
+def save_lap(path, trace):
+    path = Path(path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_bytes(encode_trace(trace))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Could not save best lap: {e}')
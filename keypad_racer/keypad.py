@@ -138,12 +138,13 @@ class Keypad:
             x, y = car.pos
             xx, yy = car.velocity
             self.pos = x+xx, y+yy
+            blockers = car.blockers_for_all_actions()
         self.blocked = tuple((
             *(
                 -1 if (x,y) == (-xx,-yy)
                 else -1 if self.xblocked[x+y*3+4]
                 else 1 if (x+y*3+4) not in self.assignments
-                else bool(car.blocker_on_path_to(x, y)) if car
+                else bool(blockers[x+y*3+4]) if car
                 else 0
                 for x in (-1, 0, 1) for y in (-1, 0, 1)
             ),
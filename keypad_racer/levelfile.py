@@ -0,0 +1,254 @@
+"""Level loading
+
+Levels are PNG files: the image holds intersection data, and custom chunks
+hold the start point (`stRt`) and rail coordinates (`raIl`).
+
+Decoding PNG in pure Python is slow, so levels can be compiled into
+`.krc` files: a raw format that can be memory-mapped, with precomputed
+tables included (see `write_compiled`).
+Levels loaded from PNG are compiled and cached on disk automatically.
+The cached copy doesn't have the crash table, which takes a while to
+compute; to include it, compile the level explicitly:
+
+    python -m keypad_racer.levelfile LEVEL.png
+
+This writes LEVEL.krc, which is used instead of LEVEL.png when it's newer.
+"""
+
+from pathlib import Path
+import collections
+import sys
+import hashlib
+import struct
+import json
+import mmap
+import zlib
+import os
+
+import numpy
+import png
+
+from .tiles import TiledGrid, nearest_cells
+from .progress import track_progress
+
+Level = collections.namedtuple(
+    'Level',
+    ('grid', 'rail_data', 'rail_pieces', 'start', 'tables'),
+)
+# grid: TiledGrid of intersection data (4 uint8 channels per cell)
+# rail_data: little-endian float16 array of (x, y) rail points
+# rail_pieces: list of (first, count) line strips in rail_data
+# start: (x, y) of the start point in the grid
+# tables: dict of precomputed arrays or TiledGrids (see compile_level)
+
+MAGIC = b'KRcircut'
+VERSION = 4
+HEADER_FORMAT = '<8sII'
+ALIGNMENT = 4096
+
+# Default speed limit for crash tables
+CRASH_TABLE_SPEED = 4
+
+class _LevelReader(png.Reader):
+    """PNG reader that collects the level's custom chunks while decoding"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.level_chunks = []
+
+    def chunk(self, *args, **kwargs):
+        chunk_type, content = super().chunk(*args, **kwargs)
+        if chunk_type in (b'stRt', b'raIl'):
+            self.level_chunks.append((chunk_type, content))
+        return chunk_type, content
+
+def read_png(data):
+    """Decode a level from PNG file contents in a single pass"""
+    reader = _LevelReader(bytes=data)
+    width, height, rows, info = reader.asRGBA8()
+    # PNG rows go top to bottom; the grid's Y axis goes up
+    intersection_data = numpy.empty((height, width, 4), numpy.uint8)
+    for y, row in zip(range(height-1, -1, -1), rows):
+        intersection_data[y] = numpy.frombuffer(
+            row, numpy.uint8,
+        ).reshape(width, 4)
+
+    start = 0, 0
+    rail_data = bytearray()
+    rail_pieces = []
+    for chunk_type, content in reader.level_chunks:
+        if chunk_type == b'stRt':
+            start = struct.unpack('<ii', content)
+        if chunk_type == b'raIl':
+            content = zlib.decompress(content)
+            # Rail coords are 2f2; 4 bytes in total.
+            rail_pieces.append((len(rail_data)//4, len(content)//4))
+            rail_data.extend(content)
+    rail_data = numpy.frombuffer(rail_data, '<f2').reshape(-1, 2)
+    grid = TiledGrid.from_dense(intersection_data)
+    return Level(grid, rail_data, rail_pieces, start, {})
+
+def compile_level(level, crash_table_speed=0):
+    """Return the level with precomputed tables added
+
+    If crash_table_speed is nonzero, a crash table is computed for states
+    up to that speed (see physics.bake_crash_table).
+    """
+    tables = dict(level.tables)
+    if 'nearest_track_cells' not in tables:
+        tables['nearest_track_cells'] = nearest_cells(level.grid)
+    if 'track_progress' not in tables:
+        result = track_progress(
+            level.grid, level.rail_data, level.rail_pieces, level.start,
+        )
+        if result:
+            progress, lap_length = result
+            tables['track_progress'] = progress
+            tables['lap_length'] = numpy.array(lap_length, numpy.float64)
+    level = level._replace(tables=tables)
+    if crash_table_speed and 'crash_table' not in tables:
+        # physics uses this module to load levels; import it late
+        from .physics import Track, bake_crash_table
+        cells, table = bake_crash_table(Track(level), crash_table_speed)
+        tables['crash_table_cells'] = cells
+        tables['crash_table'] = table
+    return level
+
+def write_compiled(path, level):
+    """Write a level as a .krc file, which read_compiled can memory-map
+
+    The file has a fixed header, a JSON table of contents, and raw arrays
+    (sections) aligned to page boundaries.
+    """
+    path = Path(path)
+    toc = {
+        'start': list(level.start),
+        'rail_pieces': [list(p) for p in level.rail_pieces],
+        'grids': {},
+        'sections': {},
+    }
+    arrays = {'rails': level.rail_data}
+    for name, value in {'intersections': level.grid, **level.tables}.items():
+        if isinstance(value, TiledGrid):
+            toc['grids'][name] = list(value.shape)
+            arrays[name + '.tiles'] = value.tiles
+            arrays[name + '.tile_table'] = value.tile_table
+        else:
+            arrays[name] = value
+    offset = ALIGNMENT
+    for name, array in arrays.items():
+        toc['sections'][name] = {
+            'offset': offset,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+        }
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    toc_data = json.dumps(toc).encode()
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(toc_data))
+    if len(header) + len(toc_data) > ALIGNMENT:
+        raise ValueError('level table of contents too long')
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(header)
+        f.write(toc_data)
+        for name, array in arrays.items():
+            f.seek(toc['sections'][name]['offset'])
+            f.write(numpy.ascontiguousarray(array).data)
+    os.replace(tmp_path, path)
+
+def read_compiled(path):
+    """Memory-map a .krc level written by write_compiled
+
+    The arrays in the result are read-only views of the mapped file,
+    so only the pages that are actually used are read from disk.
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, toc_length = struct.unpack_from(HEADER_FORMAT, mapped)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path}: not a compiled level (or wrong version)')
+    toc_start = struct.calcsize(HEADER_FORMAT)
+    toc = json.loads(mapped[toc_start:toc_start + toc_length].decode())
+    arrays = {}
+    for name, section in toc['sections'].items():
+        shape = section['shape']
+        arrays[name] = numpy.frombuffer(
+            mapped,
+            dtype=section['dtype'],
+            count=int(numpy.prod(shape)),
+            offset=section['offset'],
+        ).reshape(shape)
+    for name, shape in toc['grids'].items():
+        arrays[name] = TiledGrid(
+            arrays.pop(name + '.tiles'),
+            arrays.pop(name + '.tile_table'),
+            shape,
+        )
+    return Level(
+        arrays.pop('intersections'),
+        arrays.pop('rails'),
+        [tuple(p) for p in toc['rail_pieces']],
+        tuple(toc['start']),
+        arrays,
+    )
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'keypad_racer'
+
+def data_dir():
+    """Per-user directory for things that can't be recomputed (best laps)"""
+    base = os.environ.get('XDG_DATA_HOME') or Path.home() / '.local' / 'share'
+    return Path(base) / 'keypad_racer'
+
+def digest(data):
+    """SHA-256 of a level file's contents, as hex"""
+    return hashlib.sha256(data).hexdigest()
+
+def file_digest(path):
+    return digest(Path(path).read_bytes())
+
+def load(path):
+    """Load a .krc or PNG level
+
+    For PNG, a newer .krc file next to it is used if it exists.
+    Otherwise, a compiled copy in the on-disk cache is used if possible.
+    """
+    path = Path(path)
+    if path.suffix == '.krc':
+        return read_compiled(path)
+    compiled_path = path.with_suffix('.krc')
+    try:
+        if compiled_path.stat().st_mtime >= path.stat().st_mtime:
+            return read_compiled(compiled_path)
+    except (OSError, ValueError):
+        pass
+    data = path.read_bytes()
+    cache_path = cache_dir() / (digest(data) + '.krc')
+    try:
+        return read_compiled(cache_path)
+    except (OSError, ValueError):
+        pass
+    level = compile_level(read_png(data))
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_compiled(cache_path, level)
+    except OSError:
+        # Caching is optional
+        pass
+    return level
+
+def main(argv=sys.argv[1:]):
+    for path in argv:
+        path = Path(path)
+        level = compile_level(
+            read_png(path.read_bytes()), crash_table_speed=CRASH_TABLE_SPEED,
+        )
+        write_compiled(path.with_suffix('.krc'), level)
+        print(f'Wrote {path.with_suffix(".krc")}')
+
+if __name__ == '__main__':
+    # Under `python -m`, this module is __main__. Use the package's copy,
+    # so that physics gets the Level type it knows.
+    from keypad_racer.levelfile import main
+    main()
@@ -0,0 +1,545 @@
+"""Network races, through a relay server
+
+The server sequences the players' actions and broadcasts them; every client
+applies the same actions in the same order. Which cars block others depends
+on time (see replay.standing_time), so clients use the server's timestamps
+rather than their own clocks, and all of them see the same race.
+
+Messages are a varint length, then a type byte and a payload:
+
+- HELLO (client): JSON {"colors": [[r, g, b], ...]}, one color per car
+  the client wants to drive
+- START (server): JSON {"level": ..., "level_sha256": ...,
+  "cars": [[x, y], ...], "colors": ..., "yours": [car numbers of this client]}
+  Clients refuse to race if their level file has a different hash.
+- ACTIONS (client): pairs of varints: car number, action
+- TURNS (server): varint number of the first action in the race, then
+  records as in replay files: varint ms since the previous action, and
+  varint car number * 9 + action
+- KEYFRAME (server): the state of the race, as in replay index entries
+  (see ReplayRace.keyframe)
+
+Actions that arrive together are sent out together, as soon as the server
+gets them. Each TURNS message is encoded once and written to all clients.
+Writes don't wait for clients; a client that falls too far behind is
+disconnected, and its cars stop.
+Clients that join a race that's already going get no cars (an empty
+"yours"); they watch. They get the latest keyframe (the server makes one
+every replay.KEYFRAME_INTERVAL actions), then the TURNS since.
+
+Usage:
+
+    python -m keypad_racer.net server --cars N [--level LEVEL]
+    python -m keypad_racer.net bots [--count K] [--turns T] [POLICY]
+    python -m keypad_racer.net local [--count K] [--turns T] [POLICY]
+
+`bots` connects K headless clients driven by a tournament policy;
+`local` also starts a server for them. At the end, each client prints
+a digest of its race state; they should all be the same.
+
+The game connects to a server if KEYPAD_RACER_SERVER is set to HOST:PORT.
+"""
+
+import collections
+import asyncio
+import threading
+import argparse
+import hashlib
+import random
+import socket
+import queue
+import json
+import time
+import sys
+import io
+
+from .replay import ReplayRace, encode_varint, read_varint, KEYFRAME_INTERVAL
+from .physics import Track, ACTION_DIRECTIONS
+from . import levelfile
+from . import tournament
+
+DEFAULT_PORT = 41337
+
+HELLO = b'H'
+START = b'S'
+ACTIONS = b'A'
+TURNS = b'T'
+KEYFRAME = b'K'
+
+# Bytes of unsent data after which a client counts as too slow
+MAX_BACKLOG = 1 << 20
+# Longest message that's accepted
+MAX_MESSAGE = 1 << 16
+
+def frame(kind, payload):
+    return encode_varint(len(payload) + 1) + kind + payload
+
+class MessageBuffer:
+    """Split a byte stream into messages"""
+    def __init__(self):
+        self.data = bytearray()
+
+    def feed(self, data):
+        """Add data; return a list of complete (type, payload) messages"""
+        self.data += data
+        messages = []
+        f = io.BytesIO(self.data)
+        end = 0
+        while (length := read_varint(f)) is not None:
+            if not 0 < length <= MAX_MESSAGE:
+                raise ValueError('bad message length')
+            start = f.tell()
+            if len(self.data) < start + length:
+                break
+            messages.append((
+                bytes(self.data[start:start+1]),
+                bytes(self.data[start+1:start+length]),
+            ))
+            end = start + length
+            f.seek(end)
+        del self.data[:end]
+        return messages
+
+def read_varints(payload):
+    f = io.BytesIO(payload)
+    result = []
+    while (n := read_varint(f)) is not None:
+        result.append(n)
+    return result
+
+def encode_turns(first, records):
+    """records: (ms since previous, car number, action) triples"""
+    data = encode_varint(first)
+    for time_delta, car, action in records:
+        data += encode_varint(time_delta)
+        data += encode_varint(car * len(ACTION_DIRECTIONS) + action)
+    return frame(TURNS, bytes(data))
+
+def decode_turns(payload):
+    """Return the number of the first action, and (time delta, car, action)"""
+    first, *numbers = read_varints(payload)
+    return first, [
+        (time_delta, *divmod(code, len(ACTION_DIRECTIONS)))
+        for time_delta, code in zip(numbers[::2], numbers[1::2])
+    ]
+
+# Race state that a client who joined late starts from
+Catchup = collections.namedtuple('Catchup', ('time', 'states'))
+# time: race time of the state, in ms
+# states: state of each car, as in ReplayCar.get_state
+
+def check_level(track, start):
+    """Raise ValueError if the track isn't the server's level"""
+    digest = track.level_path and levelfile.file_digest(track.level_path)
+    if digest != start.get('level_sha256'):
+        raise ValueError(
+            f'the server races on a different level ({start["level"]})'
+        )
+
+def grid_positions(count):
+    positions = tournament.grid_positions()
+    return [next(positions) for i in range(count)]
+
+def set_nodelay(transport):
+    sock = transport.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class RelayServer:
+    """Sequences actions from all clients and broadcasts them"""
+    def __init__(self, num_cars, level_path):
+        self.num_cars = num_cars
+        self.level_path = str(level_path)
+        self.level_digest = levelfile.file_digest(level_path)
+        self.clients = []
+        self.colors = []
+        self.started = False
+        self.start_time = None
+        self.last_time = 0
+        self.num_actions = 0
+        # Actions received in this event loop iteration
+        self.pending = []
+        # For clients that join late: the race, its latest KEYFRAME message
+        # (or None), and the TURNS messages since
+        self.race = ReplayRace(Track(level_path), grid_positions(num_cars))
+        self.keyframe = None
+        self.keyframe_actions = 0
+        self.history = []
+
+    def protocol(self):
+        return _ServerProtocol(self)
+
+    def join(self, client, colors):
+        if self.started:
+            # Late joiners can watch
+            colors = []
+        colors = colors[:self.num_cars - len(self.colors)]
+        client.cars = set(range(len(self.colors), len(self.colors) + len(colors)))
+        self.colors.extend(colors)
+        self.clients.append(client)
+        if self.started:
+            self.send_start(client)
+            if self.keyframe:
+                client.send(self.keyframe)
+            for message in self.history:
+                client.send(message)
+        elif len(self.colors) >= self.num_cars:
+            self.started = True
+            self.start_time = time.monotonic()
+            for client in self.clients:
+                self.send_start(client)
+
+    def send_start(self, client):
+        client.send(frame(START, json.dumps({
+            'level': self.level_path,
+            'level_sha256': self.level_digest,
+            'cars': grid_positions(self.num_cars),
+            'colors': self.colors,
+            'yours': sorted(client.cars),
+        }).encode()))
+
+    def leave(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def add_action(self, client, car, action):
+        if not self.started or car not in client.cars:
+            return
+        if action not in ACTION_DIRECTIONS:
+            return
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        now = round((time.monotonic() - self.start_time) * 1000)
+        now = max(now, self.last_time)
+        self.pending.append((now - self.last_time, car, action))
+        self.last_time = now
+
+    def flush(self):
+        """Broadcast the actions received so far"""
+        message = encode_turns(self.num_actions, self.pending)
+        for time_delta, car, action in self.pending:
+            self.race.apply(self.race.time + time_delta, car, action)
+        self.num_actions += len(self.pending)
+        self.pending = []
+        for client in list(self.clients):
+            client.send(message)
+        if self.num_actions - self.keyframe_actions >= KEYFRAME_INTERVAL:
+            # Keyframes aren't in a file; there's no stream offset
+            self.keyframe = frame(KEYFRAME, self.race.keyframe(0))
+            self.keyframe_actions = self.num_actions
+            self.history = []
+        else:
+            self.history.append(message)
+
+class _ServerProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.buffer = MessageBuffer()
+        self.cars = set()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        set_nodelay(transport)
+
+    def connection_lost(self, exc):
+        self.server.leave(self)
+
+    def send(self, message):
+        if self.transport.get_write_buffer_size() > MAX_BACKLOG:
+            print('Disconnecting a slow client')
+            self.server.leave(self)
+            self.transport.abort()
+            return
+        self.transport.write(message)
+
+    def data_received(self, data):
+        try:
+            messages = self.buffer.feed(data)
+            for kind, payload in messages:
+                if kind == HELLO:
+                    colors = json.loads(payload)['colors']
+                    self.server.join(self, [tuple(c) for c in colors])
+                elif kind == ACTIONS:
+                    numbers = read_varints(payload)
+                    for car, action in zip(numbers[::2], numbers[1::2]):
+                        self.server.add_action(self, car, action)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f'Bad message from client: {e}')
+            self.server.leave(self)
+            self.transport.abort()
+
+async def serve(num_cars, level_path, host='localhost', port=DEFAULT_PORT):
+    relay = RelayServer(num_cars, level_path)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(relay.protocol, host, port)
+    return relay, server
+
+
+class Client:
+    """Connection to a relay server, for use with asyncio
+
+    After `connect`, `race` is a ReplayRace that the received actions are
+    applied to, and `cars` are the numbers of this client's cars.
+    `track` is the level to race on (by default, the one the server names);
+    the race has its own cars on a separate Track.
+    """
+    def __init__(self, colors, track=None):
+        self.colors = [list(c) for c in colors]
+        self.track = track
+        self.race = None
+        self.start = None
+        self.cars = []
+        self.buffer = MessageBuffer()
+        self.messages = collections.deque()
+        self.reader = self.writer = None
+
+    async def connect(self, host='localhost', port=DEFAULT_PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        set_nodelay(self.writer.transport)
+        self.writer.write(frame(HELLO, json.dumps({
+            'colors': self.colors,
+        }).encode()))
+        kind = None
+        while kind != START:
+            kind, payload = await self._read_message()
+        start = json.loads(payload)
+        if self.track is None:
+            self.track = Track(start['level'])
+        check_level(self.track, start)
+        self.start = start
+        self.cars = start['yours']
+        self.race = ReplayRace(Track(self.track.level), start['cars'])
+
+    def send(self, actions):
+        """Send (car, action) pairs"""
+        data = bytearray()
+        for car, action in actions:
+            data += encode_varint(car) + encode_varint(action)
+        self.writer.write(frame(ACTIONS, bytes(data)))
+
+    async def receive(self):
+        """Wait for the next batch of actions, apply and return them
+
+        Returns a list of replay.Record, or None when disconnected.
+        """
+        while True:
+            try:
+                kind, payload = await self._read_message()
+            except (EOFError, ConnectionError):
+                return None
+            if kind == KEYFRAME:
+                self.race.load_keyframe(payload)
+            if kind == TURNS:
+                first, records = decode_turns(payload)
+                return [
+                    self.race.apply(self.race.time + time_delta, car, action)
+                    for time_delta, car, action in records
+                ]
+
+    async def _read_message(self):
+        while not self.messages:
+            data = await self.reader.read(1 << 16)
+            if not data:
+                raise EOFError()
+            self.messages.extend(self.buffer.feed(data))
+        return self.messages.popleft()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    def digest(self):
+        """Hash of the race state, to check that clients agree"""
+        return hashlib.sha256(repr([
+            car.get_state() for car in self.race.cars
+        ]).encode()).hexdigest()[:16]
+
+
+class NetworkLink:
+    """Client running in a background thread, for the game
+
+    Actions that arrive are queued; `apply` (called from the game's clock)
+    moves the cars.
+    track: the game's Track; the server must race on the same level
+    """
+    def __init__(self, host, port, colors, track):
+        self.host = host
+        self.port = port
+        self.client = Client(colors, track)
+        self.received = queue.SimpleQueue()
+        self.started = threading.Event()
+        self.error = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+
+    async def _main(self):
+        try:
+            await self.client.connect(self.host, self.port)
+        except (OSError, ValueError) as e:
+            self.error = e
+            return
+        finally:
+            self.started.set()
+        # Records are applied by the game, not to the client's race
+        race = self.client.race
+        while True:
+            try:
+                kind, payload = await self.client._read_message()
+            except (EOFError, ConnectionError):
+                break
+            if kind == KEYFRAME:
+                race.load_keyframe(payload)
+                self.received.put(Catchup(
+                    race.time, [car.get_state() for car in race.cars],
+                ))
+            if kind == TURNS:
+                first, records = decode_turns(payload)
+                for record in records:
+                    self.received.put(record)
+        print('Disconnected from server')
+
+    def wait_start(self, timeout=None):
+        """Block until the race starts; return the START info (or None)"""
+        self.started.wait(timeout)
+        return self.client.start
+
+    def send(self, car, action):
+        self.loop.call_soon_threadsafe(self.client.send, [(car, action)])
+
+    def apply(self, group):
+        """Move the cars in a CarGroup according to actions received"""
+        while True:
+            try:
+                item = self.received.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, Catchup):
+                # Joined late
+                group.race_time = item.time
+                for car, state in zip(group.cars, item.states):
+                    car.load_state(state)
+                if group.recorder:
+                    # A replay can't start in the middle of a race
+                    group.recorder.close()
+                    group.recorder = None
+                continue
+            time_delta, car_index, action = item
+            group.race_time += time_delta
+            car = group.cars[car_index]
+            car.action_pending = False
+            if group.recorder:
+                group.recorder.record(car_index, action, group.race_time)
+            car.move(*ACTION_DIRECTIONS[action])
+
+
+async def run_bot(policy_name, turns, host='localhost', port=DEFAULT_PORT,
+                  track=None, seed=0, color=(1, 1, 1), delay=0):
+    """Drive one car with a tournament policy; return the Client
+
+    The bot sends its next action when it sees its previous one come back.
+    The Client's `latencies` are the round trip times of its actions.
+    """
+    client = Client([color], track)
+    await client.connect(host, port)
+    policy = tournament.get_policy(policy_name)
+    rng = random.Random(seed)
+    client.latencies = []
+    if not client.cars:
+        return client
+    car_index, = client.cars
+    car = client.race.cars[car_index]
+
+    def send_next():
+        nonlocal sent_time
+        sent_time = time.perf_counter()
+        client.send([(car_index, policy(car, rng))])
+
+    sent_time = None
+    send_next()
+    while car.turns < turns:
+        records = await client.receive()
+        if records is None:
+            break
+        if any(r.car == car_index for r in records):
+            client.latencies.append(time.perf_counter() - sent_time)
+            if car.turns < turns:
+                if delay:
+                    await asyncio.sleep(delay)
+                send_next()
+    return client
+
+async def run_bots(count, turns, policy_name, host, port, level_path, delay):
+    track = Track(level_path) if level_path else None
+    clients = await asyncio.gather(*(
+        run_bot(policy_name, turns, host, port, track, seed=i, delay=delay)
+        for i in range(count)
+    ))
+    # Let everyone see everybody's last moves
+    await asyncio.sleep(0.2)
+    for client in clients:
+        while True:
+            try:
+                records = await asyncio.wait_for(client.receive(), 0.05)
+            except asyncio.TimeoutError:
+                break
+            if records is None:
+                break
+    latencies = sorted(l for c in clients for l in c.latencies)
+    for i, client in enumerate(clients):
+        print(f'client {i}: {client.race.records} actions, state {client.digest()}')
+    if latencies:
+        print(
+            f'round trip: median {latencies[len(latencies)//2]*1000:.2f} ms, '
+            + f'max {latencies[-1]*1000:.2f} ms'
+        )
+    digests = {client.digest() for client in clients}
+    for client in clients:
+        client.close()
+    return len(digests) == 1
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m keypad_racer.net')
+    parser.add_argument('command', choices=('server', 'bots', 'local'))
+    parser.add_argument('policy', nargs='?', default='cautious')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--level', default='okruh.png')
+    parser.add_argument('--cars', type=int, default=2,
+        help='number of cars in the race (server)')
+    parser.add_argument('--count', type=int, default=4,
+        help='number of bot clients')
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0,
+        help='seconds a bot waits before each move')
+    args = parser.parse_args(argv)
+
+    async def run():
+        if args.command == 'server':
+            relay, server = await serve(
+                args.cars, args.level, args.host, args.port,
+            )
+            print(f'Serving on {args.host}:{args.port}')
+            await server.serve_forever()
+        if args.command == 'local':
+            relay, server = await serve(
+                args.count, args.level, args.host, args.port,
+            )
+        ok = await run_bots(
+            args.count, args.turns, args.policy, args.host, args.port,
+            args.level, args.delay,
+        )
+        print('all clients agree' if ok else 'CLIENTS DISAGREE')
+        return ok
+
+    if not asyncio.run(run()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Frame-time benchmark that renders offscreen
+
+Runs a scripted race with 1 to 9 split-screen players, drawing the same
+views as the game into an offscreen framebuffer, and reports how long each
+view takes to draw: CPU time (issuing the draw calls), GPU time (from
+a timer query), and wall time spent waiting for the GPU to finish the view.
+Software renderers like llvmpipe do most of the work while the CPU
+waits; their timer queries don't count all of it.
+
+This needs no display and no GPU; with Mesa's llvmpipe it runs on
+CI machines. For example:
+
+    python -m keypad_racer.offscreen --players 1,2,4,9 --frames 300
+
+With --cars, that many AI cars (which have no views) race as well.
+"""
+
+import argparse
+import random
+import json
+import time
+import sys
+
+import pyglet
+
+# No display, and no sound card
+pyglet.options['headless'] = True
+pyglet.options['audio'] = ('silent',)
+
+from .window import OffscreenWindow
+from .view import View
+from .scene import CarScene
+from .circuit import Circuit
+from .car import CarGroup, Car, get_trail_length, HISTORY_SIZE
+from .keypad import Keypad
+from .physics import ACTION_DIRECTIONS
+from .palette import COLORS
+from .tournament import get_policy, grid_positions
+
+def is_ready(car):
+    """True if the car's move (or crash) is over, so it can move again"""
+    return not car.crashed and float(car.anim_t) == car.anim_t.end
+
+def add_ai_cars(group, num_cars, rng):
+    """Add cars at random free cells of the track"""
+    circuit = group.circuit
+    cars = []
+    while len(cars) < num_cars:
+        x = rng.randrange(-circuit.start_x, circuit.width - circuit.start_x)
+        y = rng.randrange(-circuit.start_y, circuit.height - circuit.start_y)
+        if (x, y) in circuit.occupancy or not circuit.is_on_track(x, y):
+            continue
+        cars.append(Car(group, rng.choice(COLORS), (x, y)))
+    return cars
+
+# AI cars that may move in one frame: as if at 60 fps, with 0.5 s moves
+AI_MOVE_FRAMES = 30
+
+def run(window, circuit, num_players, frames, policy, seed=0,
+        num_ai_cars=0, ai_policy=None, trail_length=HISTORY_SIZE):
+    """Race for the given number of frames; return per-view timings
+
+    The result has, for each view, lists of CPU, GPU and wait times
+    in seconds.
+    """
+    ctx = window.ctx
+    rng = random.Random(seed)
+    window.views.clear()
+    group = CarGroup(ctx, circuit, trail_length=trail_length)
+    cars = []
+    for pos, color in zip(grid_positions(), COLORS[:num_players]):
+        car = Car(group, color, pos)
+        Keypad(ctx, car)
+        car.keypad.update()
+        window.add_view(View(ctx, CarScene(car, car.keypad)))
+        cars.append(car)
+    ai_cars = add_ai_cars(group, num_ai_cars, rng)
+    timings = [{'cpu': [], 'gpu': [], 'wait': []} for view in window.views]
+    query = ctx.query(time=True)
+    for frame in range(frames):
+        pyglet.clock.tick()
+        for car in cars:
+            # Like a player who presses a key as soon as the keypad is back
+            if car.keypad.enabled and not car.crashed:
+                car.act(policy(car, rng))
+        # The harness is slower than 60 fps; don't let AI cars move
+        # more often than they could in the game
+        for car in ai_cars[frame % AI_MOVE_FRAMES::AI_MOVE_FRAMES]:
+            if is_ready(car):
+                action = ai_policy(car, rng)
+                car.move(*ACTION_DIRECTIONS[action], sound=False)
+        window.fbo.use()
+        width, height = window.get_size()
+        ctx.scissor = (0, 0, width, height)
+        ctx.clear(0.0, 0.0, 0.0, 0.0)
+        for view, timing in zip(window.views, timings):
+            with query:
+                start = time.perf_counter()
+                view.draw()
+                end = time.perf_counter()
+                # Drivers may defer the work; make sure it's done
+                # before the query ends, so it's counted for this view
+                ctx.finish()
+            timing['cpu'].append(end - start)
+            timing['wait'].append(time.perf_counter() - end)
+            timing['gpu'].append(query.elapsed / 1e9)
+    return timings
+
+def mean_ms(values):
+    return sum(values) / len(values) * 1000
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog='python -m keypad_racer.offscreen')
+    parser.add_argument('--players', default='1,2,4,9',
+        help='comma-separated numbers of players to benchmark')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--size', default='1920x1080', help='WIDTHxHEIGHT')
+    parser.add_argument('--level', default='okruh.png')
+    parser.add_argument('--policy', default='cautious',
+        help='driving policy, see tournament.py')
+    parser.add_argument('--cars', type=int, default=0,
+        help='number of AI cars to add')
+    parser.add_argument('--car-policy', default='random',
+        help='driving policy of the AI cars')
+    parser.add_argument('--trail', default=str(HISTORY_SIZE),
+        help='trail length: a number of points, or "lap"')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+        help='print results as JSON lines')
+    args = parser.parse_args(argv)
+
+    width, sep, height = args.size.partition('x')
+    window = OffscreenWindow((int(width), int(height)))
+    circuit = Circuit(window.ctx, args.level)
+    policy = get_policy(args.policy)
+    if not args.json:
+        print(f'Renderer: {window.ctx.info["GL_RENDERER"]}, {args.size}')
+    for num_players in (int(n) for n in args.players.split(',')):
+        timings = run(
+            window, circuit, num_players, args.frames, policy, args.seed,
+            args.cars, get_policy(args.car_policy),
+            get_trail_length(circuit, args.trail),
+        )
+        cpu = [mean_ms(t['cpu']) for t in timings]
+        gpu = [mean_ms(t['gpu']) for t in timings]
+        wait = [mean_ms(t['wait']) for t in timings]
+        if args.json:
+            print(json.dumps({
+                'players': num_players, 'cars': args.cars,
+                'frames': args.frames,
+                'size': args.size, 'cpu_ms': cpu, 'gpu_ms': gpu,
+                'wait_ms': wait,
+            }))
+            continue
+        print(
+            f'{num_players} player(s): frame {sum(cpu):.2f} ms CPU, '
+            + f'{sum(gpu):.2f} ms GPU, {sum(wait):.2f} ms wait'
+        )
+        for i, (c, g, w) in enumerate(zip(cpu, gpu, wait)):
+            print(f'  view {i}: {c:.3f} ms CPU, {g:.3f} ms GPU, {w:.3f} ms wait')
+
+if __name__ == '__main__':
+    main()
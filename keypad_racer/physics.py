@@ -0,0 +1,549 @@
+"""Race simulation that doesn't need a window or GPU
+
+Track and RacingCar hold the game rules: the track grid, car movement,
+crashes, respawning and laps.
+The GL classes (Circuit and Car) build on them to draw and animate.
+"""
+
+import math
+
+import numpy
+
+from . import levelfile
+from .tiles import TiledGrid, nearest_cells
+from .progress import track_progress
+
+ACTION_DIRECTIONS = {
+    0: (-1, -1),
+    1: ( 0, -1),
+    2: (+1, -1),
+    3: (-1,  0),
+    4: ( 0,  0),
+    5: (+1,  0),
+    6: (-1, +1),
+    7: ( 0, +1),
+    8: (+1, +1),
+}
+
+ACTION_DX = numpy.array([dx for dx, dy in ACTION_DIRECTIONS.values()])
+ACTION_DY = numpy.array([dy for dx, dy in ACTION_DIRECTIONS.values()])
+
+# Codes in the crash table (see bake_crash_table)
+CRASH_NONE = 0
+CRASH_X_STEP = 1
+CRASH_Y_STEP = 128
+CRASH_AT_END = 255
+
+# Intersection data of cells that aren't on the track
+NO_INTERSECTION = bytes(4)
+
+class Track:
+    def __init__(self, level):
+        """level: a levelfile.Level, or a path to load it from"""
+        self.cars = []
+        # Cars by grid cell
+        self.occupancy = {}
+        # Sorted cars; None when cars moved since (see standings)
+        self._standings = None
+        # Where the level was loaded from (None if given a Level)
+        self.level_path = None
+        if not isinstance(level, levelfile.Level):
+            self.level_path = str(level)
+            level = levelfile.load(level)
+        # Other Tracks can share the level: Track(track.level)
+        self.level = level
+        # TiledGrid of intersection data
+        self.grid = level.grid
+        self.height, self.width = self.grid.shape
+        # Bound once: get_pixel is the hot path of every move
+        self._get_bytes = self.grid.get_bytes
+        self.rail_data = level.rail_data
+        self.rail_pieces = level.rail_pieces
+        self.start_x, self.start_y = level.start
+
+        self.nearest_track_cells = level.tables.get('nearest_track_cells')
+        if self.nearest_track_cells is None:
+            self.nearest_track_cells = nearest_cells(self.grid)
+
+        # Progress along the track, in cells from the start line (or None)
+        self.progress = level.tables.get('track_progress')
+        self.lap_length = None
+        if self.progress is None:
+            result = track_progress(
+                self.grid, level.rail_data, self.rail_pieces, level.start,
+            )
+            if result:
+                self.progress, self.lap_length = result
+        else:
+            self.lap_length = float(level.tables['lap_length'])
+
+        # Precomputed crashes for slow states (or None); see bake_crash_table
+        self.crash_table = level.tables.get('crash_table')
+        self.crash_table_cells = level.tables.get('crash_table_cells')
+        if self.crash_table is not None:
+            self.crash_table_speed = self.crash_table.shape[1] // 2
+
+    def get_pixel(self, x, y):
+        """Return the intersection data at (x, y), as 4 bytes"""
+        return self._get_bytes(x + self.start_x, y + self.start_y)
+
+    def get_pixels(self, xs, ys):
+        """Like get_pixel, for arrays of coordinates"""
+        return self.grid.get_many(
+            numpy.asarray(xs) + self.start_x,
+            numpy.asarray(ys) + self.start_y,
+        )
+
+    def add_car(self, car):
+        self.cars.append(car)
+        self.occupancy.setdefault(car.pos, []).append(car)
+        self._standings = None
+
+    def move_car(self, car, old_pos, new_pos):
+        cars_there = self.occupancy[old_pos]
+        cars_there.remove(car)
+        if not cars_there:
+            del self.occupancy[old_pos]
+        self.occupancy.setdefault(new_pos, []).append(car)
+        self._standings = None
+
+    def car_at(self, x, y):
+        """Return a car that is standing at (x, y), or None"""
+        for car in self.occupancy.get((x, y), ()):
+            if car.is_standing():
+                return car
+        return None
+
+    def is_on_track(self, x, y, check_cars=True):
+        if self.get_pixel(x, y) == NO_INTERSECTION:
+            return False
+        if check_cars and (x, y) in self.occupancy:
+            return self.car_at(x, y) is None
+        return True
+
+    def y_intersection_passable(self, x, y):
+        y0 = math.floor(y)
+        rem = y - y0
+        return (
+            rem < self.get_pixel(x, y0)[3]/255
+            or 1-rem < self.get_pixel(x, y0+1)[1]/255
+        )
+        return False
+
+    def x_intersection_passable(self, x, y):
+        x0 = math.floor(x)
+        rem = x - x0
+        return (
+            rem < self.get_pixel(x0, y)[2]/255
+            or 1-rem < self.get_pixel(x0+1, y)[0]/255
+        )
+
+    def progress_at(self, x, y):
+        """Return how far along the track (x, y) is, or None if unknown"""
+        if self.progress is None:
+            return None
+        result = float(self.progress.get(x + self.start_x, y + self.start_y))
+        if result < 0:
+            return None
+        return result
+
+    def standings(self):
+        """Return cars ordered by race position, leader first
+
+        The result is cached until a car moves or changes lap; don't
+        modify it.
+        """
+        if self._standings is None:
+            self._standings = sorted(
+                self.cars, key=lambda car: -car.race_distance,
+            )
+        return self._standings
+
+    def reset_standings(self):
+        self._standings = None
+
+    def search_free_cell(self, x, y, is_free, max_distance=100):
+        """Return the cell nearest to (x, y) for which is_free(x, y) is true
+
+        Only looks in squares up to max_distance cells around (x, y);
+        returns None if nothing's found.
+        """
+        for i in range(max_distance):
+            positions = [
+                *((x+i, py) for py in range(y-i, y+i+1)),
+                *((x-i, py) for py in range(y-i, y+i+1)),
+                *((px, y-i) for px in range(x-i, x+i+1)),
+                *((px, y+i) for px in range(x-i, x+i+1)),
+            ]
+            positions = [p for p in positions if is_free(*p)]
+            if positions:
+                return min(
+                    positions,
+                    key=lambda p: (p[0]-x)**2 + (p[1]-y)**2,
+                )
+        return None
+
+    def nearest_on_track(self, x, y):
+        """Return the track cell nearest to (x, y), ignoring cars
+
+        Returns None if (x, y) is too far from the track for the
+        precomputed table.
+        """
+        near_y, near_x = self.nearest_track_cells.get(
+            x + self.start_x, y + self.start_y,
+        ).tolist()
+        if near_y < 0:
+            return None
+        return near_x - self.start_x, near_y - self.start_y
+
+    def is_on_track_batch(self, xs, ys, check_cars=True):
+        xs, ys = numpy.broadcast_arrays(xs, ys)
+        result = self.get_pixels(xs, ys).any(axis=-1)
+        if check_cars:
+            for car_x, car_y in self.occupancy:
+                if self.car_at(car_x, car_y):
+                    result &= (xs != car_x) | (ys != car_y)
+        return result
+
+    def y_intersection_passable_batch(self, xs, ys):
+        ys = numpy.asarray(ys, dtype=float)
+        y0 = numpy.floor(ys).astype(int)
+        rem = ys - y0
+        return (
+            (rem < self.get_pixels(xs, y0)[..., 3]/255)
+            | (1-rem < self.get_pixels(xs, y0+1)[..., 1]/255)
+        )
+
+    def x_intersection_passable_batch(self, xs, ys):
+        xs = numpy.asarray(xs, dtype=float)
+        x0 = numpy.floor(xs).astype(int)
+        rem = xs - x0
+        return (
+            (rem < self.get_pixels(x0, ys)[..., 2]/255)
+            | (1-rem < self.get_pixels(x0+1, ys)[..., 0]/255)
+        )
+
+    def crash_ts_batch(self, sx, sy, dest_x, dest_y, check_cars=True):
+        """Find where straight moves from (sx, sy) to (dest_x, dest_y) crash
+
+        Does the same checks as RacingCar.blocker_on_path_to, for arrays of moves.
+        Returns the `t` of the crash for each move, or inf if there's none.
+        """
+        sx, sy, dest_x, dest_y = (
+            a.ravel() for a in numpy.broadcast_arrays(sx, sy, dest_x, dest_y)
+        )
+        crash_ts = numpy.full(sx.shape, numpy.inf)
+        for xy_range, passable in (
+            (abs(sx - dest_x), self._y_passable_rounded),
+            (abs(sy - dest_y), self._x_passable_rounded),
+        ):
+            # Sample each path at all steps 0..xy_range
+            counts = numpy.where(xy_range > 0, xy_range + 1, 0)
+            moves = numpy.repeat(numpy.arange(len(counts)), counts)
+            firsts = numpy.cumsum(counts) - counts
+            steps = numpy.arange(len(moves)) - firsts[moves]
+            t = steps / xy_range[moves]
+            x = (1-t) * sx[moves] + t * dest_x[moves]
+            y = (1-t) * sy[moves] + t * dest_y[moves]
+            crashed = ~passable(x, y)
+            numpy.minimum.at(crash_ts, moves[crashed], t[crashed])
+        on_track = self.is_on_track_batch(dest_x, dest_y, check_cars)
+        crash_ts[~on_track] = numpy.minimum(crash_ts[~on_track], 1)
+        return crash_ts
+
+    def action_crash_ts(self, x, y, vx, vy):
+        """Find where each action crashes into a wall, for arrays of states
+
+        Returns an array of shape (n, 9): the `t` of the crash for each state
+        and action (as crash_ts_batch), or inf if there's none.
+        The crash table is used where possible.
+        """
+        x, y, vx, vy = (
+            a.ravel() for a in numpy.broadcast_arrays(x, y, vx, vy)
+        )
+        result = numpy.empty((len(x), len(ACTION_DX)))
+        live = numpy.ones(len(x), bool)
+        if self.crash_table is not None:
+            max_speed = self.crash_table_speed
+            rows = self.crash_table_cells.get_many(
+                x + self.start_x, y + self.start_y,
+            )
+            known = (
+                (rows >= 0) & (abs(vx) <= max_speed) & (abs(vy) <= max_speed)
+            )
+            codes = self.crash_table[
+                rows[known], vy[known] + max_speed, vx[known] + max_speed,
+            ]
+            result[known] = decode_crash_codes(
+                codes,
+                vx[known, None] + ACTION_DX,
+                vy[known, None] + ACTION_DY,
+            )
+            live = ~known
+        if live.any():
+            sx = x[live, None]
+            sy = y[live, None]
+            result[live] = self.crash_ts_batch(
+                sx, sy,
+                sx + vx[live, None] + ACTION_DX,
+                sy + vy[live, None] + ACTION_DY,
+                check_cars=False,
+            ).reshape(-1, len(ACTION_DX))
+        return result
+
+    def _y_passable_rounded(self, x, y):
+        return self.y_intersection_passable_batch(numpy.rint(x).astype(int), y)
+
+    def _x_passable_rounded(self, x, y):
+        return self.x_intersection_passable_batch(x, numpy.rint(y).astype(int))
+
+
+def bake_crash_table(track, max_speed):
+    """Precompute crashes for all states up to max_speed in each axis
+
+    Returns a TiledGrid with a row number for each track cell (-1 for
+    cells off the track), and a uint8 array of shape
+    (rows, 2*max_speed+1, 2*max_speed+1, 9): a code for each row,
+    vy + max_speed, vx + max_speed and action.
+
+    The codes describe where moves crash into walls, as crash_ts_batch
+    finds it. To keep the table compact but exact, `t` is stored as the
+    step along the path where the crash happens:
+    - CRASH_NONE: no crash
+    - CRASH_X_STEP + k: crash at t = k / |vx| (vx after accelerating)
+    - CRASH_Y_STEP + k: crash at t = k / |vy|
+    - CRASH_AT_END: crash at t = 1 (the destination is off the track)
+    """
+    if not 0 <= max_speed < CRASH_Y_STEP - CRASH_X_STEP - 1:
+        raise ValueError(f'max_speed out of range: {max_speed}')
+    height, width = track.grid.shape
+    on_track = track.grid.region(0, 0, width, height).any(axis=-1)
+    rows = numpy.full((height, width), -1, numpy.int32)
+    rows[on_track] = numpy.arange(on_track.sum())
+    ys, xs = numpy.nonzero(on_track)
+    speeds = numpy.arange(-max_speed, max_speed + 1)
+    vx = (speeds[None, :, None] + ACTION_DX)[None]
+    vy = (speeds[:, None, None] + ACTION_DY)[None]
+    size = len(speeds)
+    table = numpy.empty((len(xs), size, size, len(ACTION_DX)), numpy.uint8)
+    # Go through the cells in chunks, to limit memory use
+    chunk_size = max(1, 2**20 // table[0].size)
+    for start in range(0, len(xs), chunk_size):
+        x = (xs[start:start+chunk_size] - track.start_x)[:, None, None, None]
+        y = (ys[start:start+chunk_size] - track.start_y)[:, None, None, None]
+        crash_ts = track.crash_ts_batch(
+            x, y, x + vx, y + vy, check_cars=False,
+        ).reshape(len(x), size, size, len(ACTION_DX))
+        table[start:start+chunk_size] = encode_crash_ts(crash_ts, vx, vy)
+    return TiledGrid.from_dense(rows, fill=-1), table
+
+def encode_crash_ts(crash_ts, vx, vy):
+    """Encode crash `t` values for moves with velocity (vx, vy)
+
+    See bake_crash_table for the codes.
+    """
+    crash_ts, vx, vy = numpy.broadcast_arrays(crash_ts, vx, vy)
+    codes = numpy.full(crash_ts.shape, CRASH_NONE, numpy.uint8)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for speed, first_code in (
+            (abs(vy), CRASH_Y_STEP), (abs(vx), CRASH_X_STEP),
+        ):
+            steps = numpy.rint(crash_ts * speed)
+            exact = (speed > 0) & (steps / speed == crash_ts)
+            codes[exact] = first_code + steps[exact]
+    codes[crash_ts == 1] = CRASH_AT_END
+    return codes
+
+def decode_crash_codes(codes, vx, vy):
+    """Decode crash `t` values from codes; inverse of encode_crash_ts"""
+    codes, vx, vy = numpy.broadcast_arrays(codes, vx, vy)
+    crash_ts = numpy.full(codes.shape, numpy.inf)
+    x_steps = (CRASH_X_STEP <= codes) & (codes < CRASH_Y_STEP)
+    crash_ts[x_steps] = (codes[x_steps] - CRASH_X_STEP) / abs(vx[x_steps])
+    y_steps = (CRASH_Y_STEP <= codes) & (codes < CRASH_AT_END)
+    crash_ts[y_steps] = (codes[y_steps] - CRASH_Y_STEP) / abs(vy[y_steps])
+    crash_ts[codes == CRASH_AT_END] = 1
+    return crash_ts
+
+class RacingCar:
+    def __init__(self, track, pos):
+        self.track = track
+        self._pos = pos
+        self.last_pos = pos
+        self.velocity = 0, 1
+        self.track.add_car(self)
+        self.lap = 1
+        self.max_lap = 1
+        self.crash_count = 0
+        self._blockers_state = None
+        self.track_progress = track.progress_at(*pos) or 0
+
+    @property
+    def pos(self):
+        return self._pos
+    @pos.setter
+    def pos(self, new):
+        self.track.move_car(self, self._pos, new)
+        self._pos = new
+
+    def is_standing(self):
+        """True if the car blocks others from moving to its cell"""
+        return True
+
+    def move(self, dx, dy):
+        """Accelerate by (dx, dy), then move
+
+        Returns the cell the car was heading to, and the crash point
+        (x, y, t) or None.
+        On a crash, the car stops and moves to a respawn point right away.
+        """
+        x, y = self.last_pos = self.pos
+        vx, vy = self.velocity
+        vx += dx
+        vy += dy
+        new = x + vx, y + vy
+        blocker = None
+        if (vx or vy) and not self.track.is_on_track(*new):
+            blocker = self.blocker_on_path_to(dx, dy)
+        if blocker:
+            self.crash_count += 1
+            self.velocity = 0, 0
+            self.pos = self.find_respawn_pos(blocker)
+        else:
+            self.velocity = vx, vy
+            self.pos = new
+        self.update_progress(self.pos)
+        return new, blocker
+
+    def act(self, action):
+        if (xy := ACTION_DIRECTIONS.get(action)):
+            return self.move(*xy)
+        return None
+
+    def update_progress(self, pos):
+        track = self.track
+        progress = track.progress_at(*pos)
+        if progress is None:
+            return
+        # A jump of more than half a lap means the start line was crossed
+        half_lap = track.lap_length / 2
+        if self.track_progress - progress > half_lap:
+            self.lap += 1
+        elif progress - self.track_progress > half_lap:
+            self.lap -= 1
+        self.track_progress = progress
+        track.reset_standings()
+        if self.lap > self.max_lap:
+            self.max_lap = self.lap
+            self.on_new_lap()
+
+    def on_new_lap(self):
+        """Called when the car starts a lap it hasn't driven before"""
+
+    @property
+    def race_distance(self):
+        """Distance driven along the track, in cells"""
+        if self.track.progress is None:
+            return 0
+        return (self.lap - 1) * self.track.lap_length + self.track_progress
+
+    @property
+    def speed(self):
+        return math.sqrt(self.velocity[0]**2 + self.velocity[1]**2)
+
+    def find_respawn_pos(self, blocker):
+        bx, by, t = blocker
+        bx = round(bx)
+        by = round(by)
+        track = self.track
+        nearest = track.nearest_on_track(bx, by)
+        if nearest is not None:
+            if track.is_on_track(*nearest):
+                return nearest
+            # The nearest cell is taken by a car; look around it
+            bx, by = nearest
+        result = track.search_free_cell(bx, by, track.is_on_track)
+        if result is not None:
+            return result
+        # !?
+        print('No respawn point found...?!')
+        return bx, by
+
+    def blocker_on_direction(self, direction):
+        if direction in ACTION_DIRECTIONS:
+            return self.blockers_for_all_actions()[direction]
+        return None
+
+    def blockers_for_all_actions(self):
+        """Return blocker_on_path_to results for all ACTION_DIRECTIONS
+
+        Crashes into walls are computed once per (pos, velocity) state;
+        only other cars are checked on each call.
+        """
+        state = self.pos, self.velocity
+        if state != self._blockers_state:
+            sx, sy = self.pos
+            vx, vy = self.velocity
+            dest_xs = sx + vx + ACTION_DX
+            dest_ys = sy + vy + ACTION_DY
+            crash_ts = self.track.action_crash_ts(sx, sy, vx, vy)[0]
+            self._wall_blockers = [
+                _blocker_at(sx, sy, dest_x, dest_y, t)
+                for dest_x, dest_y, t in zip(
+                    dest_xs.tolist(), dest_ys.tolist(), crash_ts.tolist(),
+                )
+            ]
+            self._dests = list(zip(dest_xs.tolist(), dest_ys.tolist()))
+            self._blockers_state = state
+        track = self.track
+        blockers = list(self._wall_blockers)
+        for action, dest in enumerate(self._dests):
+            if blockers[action] is None and track.car_at(*dest):
+                blockers[action] = _blocker_at(*self.pos, *dest, 1)
+        return blockers
+
+    def blocker_on_path_to(self, x, y):
+        crash_ts = []
+        track = self.track
+        sx, sy = self.pos
+        vx, vy = self.velocity
+        dest_x = sx + vx + x
+        dest_y = sy + vy + y
+        xrange = abs(sx - dest_x)
+        if xrange:
+            for t in range(xrange + 1):
+                t /= xrange
+                x = (1-t) * sx + t * dest_x
+                y = (1-t) * sy + t * dest_y
+                ok = track.y_intersection_passable(round(x), y);
+                if not ok:
+                    crash_ts.append(t)
+                    break
+
+        yrange = abs(sy - dest_y)
+        if yrange:
+            for t in range(yrange + 1):
+                t /= yrange
+                x = (1-t) * sx + t * dest_x
+                y = (1-t) * sy + t * dest_y
+                ok = track.x_intersection_passable(x, round(y))
+                if not ok:
+                    crash_ts.append(t)
+                    break
+        if not track.is_on_track(dest_x, dest_y):
+            crash_ts.append(1)
+
+        if crash_ts:
+            t = min(crash_ts)
+            x = (1-t) * sx + t * dest_x
+            y = (1-t) * sy + t * dest_y
+            return x, y, t
+        return None
+
+
+def _blocker_at(sx, sy, dest_x, dest_y, t):
+    if t == math.inf:
+        return None
+    x = (1-t) * sx + t * dest_x
+    y = (1-t) * sy + t * dest_y
+    return x, y, t
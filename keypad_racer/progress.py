@@ -0,0 +1,102 @@
+"""Race progress: how far along the track each cell is
+
+Progress is measured along the rails, in cells, from the start line.
+The start line goes through the cell just behind the start point;
+cars start going "up" (towards +y).
+"""
+
+import math
+
+import numpy
+
+from .tiles import TiledGrid, nearest_true_cells
+
+# Rails are resampled with this spacing (in cells) before measuring
+SAMPLE_SPACING = 1/32
+
+def track_progress(grid, rail_data, rail_pieces, start):
+    """Compute progress for all cells of the track
+
+    Returns a TiledGrid of float32 progress (-1 for cells that aren't
+    on the track) and the length of a lap, or None if the track has
+    no rails.
+
+    Each rail (border of the track) gives an estimate for each cell:
+    the position of the nearest point on that rail, as a fraction of the
+    rail's length. The estimates are averaged, and scaled by the average
+    rail length.
+    """
+    height, width = grid.shape
+    on_track = grid.region(0, 0, width, height).any(axis=-1)
+    pieces = [(first, count) for first, count in rail_pieces if count > 1]
+    if not pieces or not on_track.any():
+        return None
+    ys, xs = numpy.nonzero(on_track)
+    angles = []
+    lengths = []
+    for first, count in pieces:
+        points = numpy.asarray(rail_data[first:first+count], numpy.float64)
+        samples, fractions, length = _lap_fractions(points, start)
+        if not length:
+            continue
+        # Each cell near the rail gets the fraction of the rail point that's
+        # nearest to its centre...
+        cell_x, cell_y = numpy.rint(samples).astype(int).T
+        inside = (
+            (0 <= cell_x) & (cell_x < width) & (0 <= cell_y) & (cell_y < height)
+        )
+        distances = numpy.hypot(*(samples - numpy.rint(samples)).T)
+        order = numpy.argsort(-distances[inside], kind='stable')
+        seeds = numpy.full((height, width), numpy.nan)
+        seeds[cell_y[inside][order], cell_x[inside][order]] = (
+            fractions[inside][order]
+        )
+        # ... and other cells get the value of the nearest such cell
+        nearest = nearest_true_cells(~numpy.isnan(seeds))
+        near_y, near_x = nearest[ys, xs].T
+        angles.append(seeds[near_y, near_x] * math.tau)
+        lengths.append(length)
+    if not lengths:
+        return None
+    # Average on a circle, so laps wrap around correctly
+    angles = numpy.array(angles)
+    mean_angle = numpy.arctan2(
+        numpy.sin(angles).sum(axis=0),
+        numpy.cos(angles).sum(axis=0),
+    )
+    lap_length = sum(lengths) / len(lengths)
+    progress = numpy.full((height, width), -1, numpy.float32)
+    progress[ys, xs] = (mean_angle / math.tau) % 1 * lap_length
+    return TiledGrid.from_dense(progress, fill=-1), lap_length
+
+def _lap_fractions(points, start):
+    """Resample a closed rail, and measure it from the start line
+
+    Returns the sample points, their distance from the start line as a
+    fraction of the whole rail (in the direction cars go), and the rail
+    length.
+    """
+    distances = numpy.hypot(*numpy.diff(points, axis=0).T)
+    arc = numpy.concatenate(([0], numpy.cumsum(distances)))
+    length = arc[-1]
+    if not length:
+        return points, numpy.zeros(len(points)), 0
+    sample_arc = numpy.arange(0, length, SAMPLE_SPACING)
+    samples = numpy.stack((
+        numpy.interp(sample_arc, arc, points[:, 0]),
+        numpy.interp(sample_arc, arc, points[:, 1]),
+    ), axis=-1)
+
+    start_x, start_y = start
+    origin = numpy.argmin(numpy.hypot(
+        samples[:, 0] - start_x, samples[:, 1] - (start_y - 0.5),
+    ))
+    # Rails may go either way around the track; look about a cell
+    # around the start to find out which
+    window = round(1 / SAMPLE_SPACING)
+    n = len(samples)
+    direction = samples[(origin + window) % n] - samples[(origin - window) % n]
+    fractions = (sample_arc - sample_arc[origin]) / length
+    if direction[1] < 0:
+        fractions = -fractions
+    return samples, fractions % 1, length
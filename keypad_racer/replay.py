@@ -0,0 +1,337 @@
+"""Race recording and playback
+
+A replay is two files:
+
+- NAME.krr, the action stream: a header, then one record per action.
+  A record is two varints: milliseconds since the previous record, and
+  car number * 9 + action. Each car's turn number is implicit (it's the
+  count of that car's records so far).
+  The header has the wall-clock time the recording started (`start_time`,
+  as from time.time()), so record times can be turned into wall-clock
+  times (see ReplayReader.wall_time).
+- NAME.kri, the keyframe index: the state of all cars after every
+  KEYFRAME_INTERVAL records, with the offset of the next record in the
+  stream. Entries have a fixed size, so any keyframe can be found directly.
+
+Both are flushed after each record, so a crash loses at most the last turn.
+
+Playback re-runs the actions with the RacingCar rules. Whether a car blocks
+others depends on whether its move animation is done (see Car.is_standing);
+this is reproduced from the recorded times.
+To seek, the nearest keyframe before the target is loaded, and at most
+KEYFRAME_INTERVAL records are replayed from there.
+
+The game records races when KEYPAD_RACER_RECORD is set to a directory.
+
+Usage: python -m keypad_racer.replay NAME.krr [RECORD_NUMBER]
+"""
+
+from pathlib import Path
+import collections
+import struct
+import json
+import time
+import math
+import sys
+
+from .physics import Track, RacingCar, ACTION_DIRECTIONS
+
+MAGIC = b'KRreplay'
+INDEX_MAGIC = b'KRrindex'
+VERSION = 1
+HEADER_FORMAT = '<8sI'
+INDEX_HEADER_FORMAT = '<8sII'
+
+KEYFRAME_INTERVAL = 256
+# Keyframe entry: stream offset, number of records, time in ms;
+# followed by CAR_STATE_FORMAT for each car
+KEYFRAME_FORMAT = '<QQQ'
+# x, y, last x, last y, vx, vy, lap, max lap, crash count, turns,
+# track progress, standing time
+CAR_STATE_FORMAT = '<10i2d'
+
+# Car.move animates moves for this long (half as long if the car stands still)
+MOVE_DURATION_MS = 500
+
+Record = collections.namedtuple('Record', ('time', 'car', 'turn', 'action'))
+# time: milliseconds since the start of the race
+# car: index of the car (in the order of the header's `cars`)
+# turn: number of the car's move, starting at 1
+# action: action number (key of ACTION_DIRECTIONS)
+
+def encode_varint(n):
+    result = bytearray()
+    while n >= 0x80:
+        result.append(n & 0x7f | 0x80)
+        n >>= 7
+    result.append(n)
+    return result
+
+def read_varint(f):
+    """Read a varint from a binary file; return None at end of file"""
+    result = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        result |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return result
+        shift += 7
+
+def standing_time(now, moved, blocker):
+    """Return the time (in ms) after which a car that just moved blocks others
+
+    This matches the move animation in Car.move: cars stand when it's
+    almost done. Crashed cars stop before the end of their move animation;
+    they don't block until they move again.
+    """
+    if blocker and blocker[2] <= 0.99:
+        return math.inf
+    duration = MOVE_DURATION_MS
+    if not moved:
+        duration /= 2
+    return now + duration * 0.99
+
+def index_path(path):
+    return Path(path).with_suffix('.kri')
+
+class ReplayCar(RacingCar):
+    def __init__(self, race, pos):
+        self.race = race
+        self.turns = 0
+        # Race time after which the car blocks others
+        self.standing_time = math.inf
+        super().__init__(race.track, pos)
+
+    def is_standing(self):
+        return self.race.time > self.standing_time
+
+    def move(self, dx, dy):
+        start = self.pos
+        new, blocker = super().move(dx, dy)
+        self.standing_time = standing_time(self.race.time, start != new, blocker)
+        return new, blocker
+
+    def get_state(self):
+        return (
+            *self.pos, *self.last_pos, *self.velocity,
+            self.lap, self.max_lap, self.crash_count, self.turns,
+            self.track_progress, self.standing_time,
+        )
+
+    def set_state(self, state):
+        x, y, lx, ly, vx, vy, *rest = state
+        self.pos = x, y
+        self.last_pos = lx, ly
+        self.velocity = vx, vy
+        (
+            self.lap, self.max_lap, self.crash_count, self.turns,
+            self.track_progress, self.standing_time,
+        ) = rest
+        self._blockers_state = None
+
+class ReplayRace:
+    """Headless race that actions are applied to
+
+    Holds the state needed for playback, and for keyframes when recording.
+    """
+    def __init__(self, track, starts):
+        self.track = track
+        self.time = 0
+        self.records = 0
+        self.cars = [ReplayCar(self, tuple(pos)) for pos in starts]
+
+    def apply(self, time_ms, car_index, action):
+        self.time = time_ms
+        self.records += 1
+        car = self.cars[car_index]
+        car.turns += 1
+        car.act(action)
+        return Record(time_ms, car_index, car.turns, action)
+
+    def keyframe(self, offset):
+        return struct.pack(
+            KEYFRAME_FORMAT, offset, self.records, self.time,
+        ) + b''.join(
+            struct.pack(CAR_STATE_FORMAT, *car.get_state())
+            for car in self.cars
+        )
+
+    def load_keyframe(self, data):
+        """Restore state from a keyframe; return its stream offset"""
+        offset, self.records, self.time = struct.unpack_from(
+            KEYFRAME_FORMAT, data,
+        )
+        pos = struct.calcsize(KEYFRAME_FORMAT)
+        for car in self.cars:
+            car.set_state(struct.unpack_from(CAR_STATE_FORMAT, data, pos))
+            pos += struct.calcsize(CAR_STATE_FORMAT)
+        return offset
+
+class ReplayWriter:
+    """Record a race as it's played
+
+    track: the race's Track (keyframes are simulated on a separate Track
+        with the same level)
+    starts: starting positions of the cars
+    """
+    def __init__(self, path, track, starts,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.keyframe_interval = keyframe_interval
+        self.race = ReplayRace(Track(track.level), starts)
+        self.start_time = time.monotonic()
+        self.last_time = 0
+        header = json.dumps({
+            'level': str(track.level_path),
+            'start_time': time.time(),
+            'cars': [list(pos) for pos in starts],
+            'keyframe_interval': keyframe_interval,
+        }).encode()
+        self.stream = open(path, 'wb')
+        self.stream.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION))
+        self.stream.write(encode_varint(len(header)))
+        self.stream.write(header)
+        self.stream.flush()
+        self.index = open(index_path(path), 'wb')
+        self.index.write(struct.pack(
+            INDEX_HEADER_FORMAT, INDEX_MAGIC, VERSION, len(starts),
+        ))
+        self._write_keyframe()
+
+    def record(self, car_index, action, time_ms=None):
+        """Record an action of a car; call this before the car moves
+
+        time_ms is the race time of the action; by default, the time since
+        the writer was created.
+        """
+        if time_ms is None:
+            time_ms = round((time.monotonic() - self.start_time) * 1000)
+        now = max(time_ms, self.last_time)
+        self.stream.write(
+            encode_varint(now - self.last_time)
+            + encode_varint(car_index * len(ACTION_DIRECTIONS) + action)
+        )
+        self.stream.flush()
+        self.last_time = now
+        self.race.apply(now, car_index, action)
+        if self.race.records % self.keyframe_interval == 0:
+            self._write_keyframe()
+
+    def _write_keyframe(self):
+        self.index.write(self.race.keyframe(self.stream.tell()))
+        self.index.flush()
+
+    def close(self):
+        self.stream.close()
+        self.index.close()
+
+class ReplayReader:
+    """Play back a recorded race
+
+    Iterating gives Records, applying them to `race` (a ReplayRace).
+    """
+    def __init__(self, path, track=None):
+        self.path = Path(path)
+        self.stream = open(self.path, 'rb')
+        magic, version = struct.unpack(
+            HEADER_FORMAT, self.stream.read(struct.calcsize(HEADER_FORMAT)),
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path}: not a supported replay file')
+        self.header = json.loads(self.stream.read(read_varint(self.stream)))
+        self.keyframe_interval = self.header['keyframe_interval']
+        # Wall-clock time of the start (None for replays recorded without it)
+        self.start_time = self.header.get('start_time')
+        if track is None:
+            track = Track(self.header['level'])
+        self.race = ReplayRace(track, self.header['cars'])
+        self.keyframe_size = (
+            struct.calcsize(KEYFRAME_FORMAT)
+            + struct.calcsize(CAR_STATE_FORMAT) * len(self.race.cars)
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        time_delta = read_varint(self.stream)
+        code = read_varint(self.stream)
+        if code is None:
+            raise StopIteration
+        car_index, action = divmod(code, len(ACTION_DIRECTIONS))
+        return self.race.apply(self.race.time + time_delta, car_index, action)
+
+    def wall_time(self, record):
+        """Return the wall-clock time of a Record, as from time.time()"""
+        if self.start_time is None:
+            return None
+        return self.start_time + record.time / 1000
+
+    def seek(self, records):
+        """Go to the state after the given number of records
+
+        Returns False if the replay is shorter than that (and stays at its
+        end).
+        """
+        keyframe = records // self.keyframe_interval
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                magic, version, num_cars = struct.unpack(
+                    INDEX_HEADER_FORMAT,
+                    f.read(struct.calcsize(INDEX_HEADER_FORMAT)),
+                )
+                if (magic, version, num_cars) != (
+                    INDEX_MAGIC, VERSION, len(self.race.cars),
+                ):
+                    raise ValueError(f'{f.name}: bad replay index')
+                header_size = f.tell()
+                # The last entry may be missing (or cut short) if recording
+                # stopped while writing it
+                entries = (
+                    f.seek(0, 2) - header_size
+                ) // self.keyframe_size
+                keyframe = min(keyframe, entries - 1)
+                f.seek(header_size + keyframe * self.keyframe_size)
+                data = f.read(self.keyframe_size)
+        except OSError:
+            keyframe = -1
+        if keyframe < 0:
+            # No index; replay from the start
+            if records < self.race.records:
+                raise ValueError('cannot seek backwards without an index')
+        else:
+            offset = self.race.load_keyframe(data)
+            self.stream.seek(offset)
+        while self.race.records < records:
+            if next(self, None) is None:
+                return False
+        return True
+
+    def close(self):
+        self.stream.close()
+
+def main(argv=sys.argv[1:]):
+    path, *rest = argv
+    reader = ReplayReader(path)
+    if rest:
+        reader.seek(int(rest[0]))
+    else:
+        for record in reader:
+            pass
+    race = reader.race
+    print(f'{path}: {race.records} actions, {race.time/1000:.1f} s')
+    if reader.start_time is not None:
+        start = time.localtime(reader.start_time)
+        print(time.strftime('started %Y-%m-%d %H:%M:%S', start))
+    for i, car in enumerate(race.cars):
+        print(
+            f'car {i}: turn {car.turns}, lap {car.max_lap}, '
+            + f'{car.crash_count} crashes, at {car.pos}'
+        )
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,13 @@ class CarScene(Scene):
             ]
             if car.crash_count:
                 stats.insert(1, f'Crashes: {car.crash_count}')
+            standings = car.group.circuit.standings()
+            if len(standings) > 1:
+                position = standings.index(car)
+                stats.insert(0, f'Position: {position+1}/{len(standings)}')
+                if position:
+                    gap = standings[0].race_distance - car.race_distance
+                    stats.insert(1, f'Gap: {gap:.0f}')
             for n, lap_time in enumerate(car.lap_times, start=1):
                 stats.append(f'Lap {n}: {format_time(lap_time)}')
             self.text.update('\n'.join(stats))
@@ -47,6 +54,15 @@ class CarScene(Scene):
                 override={'projection_params': (0, 0, 8*w/h, 8)},
             )
 
+class SpectatorScene(Scene):
+    """Follows a car that isn't driven from this window"""
+    def __init__(self, car):
+        self.car = car
+
+    def draw(self, view):
+        view.set_view_rect(self.car.view_rect)
+        self.car.group.draw(view)
+
 class KeypadScene(Scene):
     fixed_projection = True
     get_mouse_events = True
@@ -24,12 +24,12 @@ void main() {
     gl_FragColor = v_color;
     float sdf = sdTrapezoid(v_uv, 0.60, 0.43, 0.9);
     if (sdf < 0) {
-        gl_FragColor = vec4(v_color.xyz, 1.0);
+        gl_FragColor = v_color;
         return;
     }
     float aa = 3 * gridlines_per_px();
     if (sdf < aa) {
-        gl_FragColor = vec4(v_color.xyz, 1.0 - sdf/aa);
+        gl_FragColor = vec4(v_color.xyz, v_color.a * (1.0 - sdf/aa));
         return;
     }
     discard;
@@ -5,7 +5,10 @@ in vec2 uv;
 in vec4 pos;
 in vec4 color;
 in vec2 orientation;
-in float pos_t;
+// Move animation: start time, duration, start & end value
+in vec4 anim;
+
+uniform float time;
 
 out float v_thickness;
 out vec4 v_color;
@@ -13,7 +16,14 @@ out vec2 v_uv;
 
 void main() {
     float aa = 1.0;
+    float pos_t = mix(anim.z, anim.w, clamp((time - anim.x) / anim.y, 0, 1));
     vec2 carpos = mix(pos.xy, pos.zw, 1-pos_t);
+    // Cull cars outside the view: put them outside the clip volume
+    vec2 distance = abs(carpos - projection_params.xy) - projection_params.zw;
+    if (max(distance.x, distance.y) > 1.0) {
+        gl_Position = vec4(0.0, 0.0, 2.0, 1.0);
+        return;
+    }
     float carorient = mix(orientation.x, orientation.y, clamp(0.2-pos_t, 0, 1));
     gl_Position = vec4(
         world_transform(carpos, rotate(carorient) * uv/2, aa),
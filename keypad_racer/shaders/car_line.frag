@@ -1,8 +1,9 @@
 #version 330
 #include world_project.inc
 
-uniform vec4 color;
+uniform int trail_length;
 
+flat in vec4 g_color;
 in float g_t;
 in float g_thickness;
 in float g_distance;
@@ -19,17 +20,17 @@ vec4 gradient_palette(vec3 color, float t) {
 
 void main() {
     float d = abs(g_distance);
-    vec4 g_color = gradient_palette(color.xyz, (g_t+1-color.w-d/5)/5);
+    vec4 color = gradient_palette(g_color.rgb, (g_t+1-g_color.a-d/5)/max(trail_length-1, 1));
     float thickness = g_thickness;
-    gl_FragColor = g_color;
+    gl_FragColor = color;
     if (d < thickness) {
-        gl_FragColor = g_color;
+        gl_FragColor = color;
         return;
     }
     d -= thickness;
     float aa = gridlines_per_px();
     if (d < aa) {
-        gl_FragColor = vec4(g_color.rgb, g_color.a * (1.0-d/aa));
+        gl_FragColor = vec4(color.rgb, color.a * (1.0-d/aa));
         return;
     }
     discard;
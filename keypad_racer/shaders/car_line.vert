@@ -1,10 +1,21 @@
 #version 330
 
-in float t;
-in vec2 point;
+// Trail points: a ring buffer in each row (see TrailRing in car.py)
+uniform isampler2D history;
+uniform int trail_length;
+uniform float time;
+
+// Per instance (car)
+in vec4 color;
+// Move animation: start time, duration, start & end value
+in vec4 anim;
+// Number of the first trail point, and of the point after the last one
+in ivec2 trail;
 
 out float v_thickness;
 out float v_t;
+out vec4 v_color;
+out float v_visible;
 
 void main() {
     float alpha;
@@ -16,6 +27,16 @@ void main() {
         alpha = 1.0;
         v_thickness = thickness;
     }
-    v_t = t;
-    gl_Position = vec4(point, 0.0, 1.0);
+    // The strip is the last trail_length points, with the first and last
+    // repeated for adjacency. Before there are enough points, the first
+    // one is repeated.
+    int n = max(gl_VertexID - 1, 0);
+    int point = clamp(trail.y - trail_length + n, trail.x, max(trail.y - 1, trail.x));
+    v_t = float(n);
+    float anim_t = mix(anim.z, anim.w, clamp((time - anim.x) / anim.y, 0, 1));
+    v_color = vec4(color.rgb, anim_t);
+    // Ghosts (translucent) have no trail
+    v_visible = float(color.a == 1.0);
+    ivec2 texel = ivec2(point % textureSize(history, 0).x, gl_InstanceID);
+    gl_Position = vec4(vec2(texelFetch(history, texel, 0).rg), 0.0, 1.0);
 }
@@ -1,13 +1,14 @@
 #version 330
 
-uniform sampler2D intersections_tex;
+uniform usampler2D page_table;
+uniform sampler2D tile_atlas;
+uniform int tile_size;
+uniform int atlas_slots;
 uniform ivec2 grid_origin;
 
 in vec2 grid_uv;
 flat in vec2 line_width;
 flat in vec2 antialias;
-in vec2 v_screenuv;
-in vec2 v_screenuv_norm;
 
 float c1(float dist, float lw, float aa) {
     dist = abs(dist - 0.5);
@@ -26,6 +27,21 @@ vec2 c(vec2 tile_pos) {
         c1(dist.y, line_width.y, antialias.y));
 }
 
+vec4 get_intersections(ivec2 pos) {
+    // Look up a cell in the tile atlas, via the page table
+    if (pos.x < 0 || pos.y < 0) return vec4(0.0);
+    ivec2 tile = pos / tile_size;
+    if (any(greaterThanEqual(tile, textureSize(page_table, 0)))) {
+        return vec4(0.0);
+    }
+    int slot = int(texelFetch(page_table, tile, 0).r);
+    ivec2 atlas_pos = (
+        ivec2(slot % atlas_slots, slot / atlas_slots) * tile_size
+        + pos % tile_size
+    );
+    return texelFetch(tile_atlas, atlas_pos, 0);
+}
+
 void main() {
     vec2 tpos = fract(grid_uv);
     vec2 cr = vec2(c(tpos).x, c(tpos).y);
@@ -58,37 +74,17 @@ void main() {
             neighbour.y += 1;
         }
     }
-    vec4 intersections = texelFetch(intersections_tex, tilepos, 0);
-    vec4 neighbour_int = texelFetch(intersections_tex, neighbour, 0);
-    vec3 base_color = mix(
-        vec3(0.1, 0.1, 0.2),
-        vec3(0.12, 0.11, 0.1),
-        v_screenuv.y / 2.0 + 0.5);
-    if (strength == 0) {
-        gl_FragColor = vec4(base_color, 1.0);
-    } else {
-        vec3 grid_color;
-        if (
-            (arm_dist < intersections[arm_axis])
-            || (((1-arm_dist)) < neighbour_int[(arm_axis+2)%4])
-        ) {
-            grid_color = mix(
-                vec3(0.27, 0.28, 0.32),
-                vec3(0.13, 0.18, 0.21),
-                clamp(0.0, 1.0, length(v_screenuv_norm)));
-        } else {
-            grid_color = mix(
-                vec3(0.27, 0.28, 0.32),
-                vec3(0.13, 0.18, 0.21),
-                clamp(0.0, 1.0, length(v_screenuv_norm))).zyx;
-        }
-        if ((intersections != vec4(0.0))) {
-            grid_color *= 1+pointstrength;
-        }
-        grid_color = mix(
-            base_color,
-            grid_color,
-            strength);
-        gl_FragColor = vec4(grid_color, 1.0);
+    vec4 intersections = get_intersections(tilepos);
+    vec4 neighbour_int = get_intersections(neighbour);
+    // Colors depend on the position on screen; they're applied when
+    // the cached tiles are drawn (grid_composite.frag)
+    float on_arm = float(
+        (arm_dist < intersections[arm_axis])
+        || (((1-arm_dist)) < neighbour_int[(arm_axis+2)%4])
+    );
+    float point = 0.0;
+    if ((intersections != vec4(0.0))) {
+        point = pointstrength;
     }
+    gl_FragColor = vec4(strength, on_arm, point, 0.0);
 }
@@ -0,0 +1,24 @@
+#version 330
+
+uniform sampler2D tile_cache;
+uniform vec4 rail_color;
+
+in vec2 cache_uv;
+in vec3 base_color;
+in vec2 v_screenuv_norm;
+
+void main() {
+    // Rendered by grid.frag, with rails in the alpha channel
+    vec4 cached = texture(tile_cache, cache_uv);
+    float strength = cached.r;
+    float on_arm = cached.g;
+    float point = cached.b;
+    float rail = cached.a;
+    vec3 grid_color = mix(
+        vec3(0.27, 0.28, 0.32),
+        vec3(0.13, 0.18, 0.21),
+        clamp(0.0, 1.0, length(v_screenuv_norm)));
+    grid_color = mix(grid_color.zyx, grid_color, on_arm) * (1+point);
+    vec3 color = mix(base_color, grid_color, strength);
+    gl_FragColor = vec4(mix(color, rail_color.rgb, rail), 1.0);
+}
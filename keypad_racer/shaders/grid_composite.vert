@@ -0,0 +1,41 @@
+#version 330
+
+uniform vec4 projection_params;
+uniform vec4 viewport;
+uniform float tile_cells;
+uniform int tile_size;
+uniform float cache_size;
+
+in vec2 corner;
+in ivec2 tile;
+in ivec2 slot;
+
+out vec2 cache_uv;
+out vec3 base_color;
+out vec2 v_screenuv_norm;
+
+void main() {
+    vec2 pan = projection_params.xy;
+    vec2 scale = projection_params.zw;
+    vec2 pos = (vec2(tile) + corner) * tile_cells;
+    gl_Position = vec4((pos - pan) / scale, 0.0, 1.0);
+    // Cached tiles have a border of 1px
+    cache_uv = (
+        vec2(slot) * (tile_size + 2) + 1 + corner * tile_size
+    ) / cache_size;
+    vec2 v_screenuv = gl_Position.xy;
+    // Linear in screen y, so it can be interpolated
+    base_color = mix(
+        vec3(0.1, 0.1, 0.2),
+        vec3(0.12, 0.11, 0.1),
+        v_screenuv.y / 2.0 + 0.5);
+    if (viewport.z > viewport.w) {
+        v_screenuv_norm = vec2(
+            v_screenuv.x * viewport.z / viewport.w,
+            v_screenuv.y);
+    } else {
+        v_screenuv_norm = vec2(
+            v_screenuv.x,
+            v_screenuv.y * viewport.w / viewport.z);
+    }
+}
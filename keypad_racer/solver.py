@@ -0,0 +1,310 @@
+"""Find the fastest lap around a track
+
+The state of a car is its position and velocity; each turn it picks one of
+the nine ACTION_DIRECTIONS. The solver runs A* over this state graph:
+
+- Moves that crash are pruned, using the game's rule (RacingCar.move):
+  a move crashes if it ends off the track. A move that ends on the track
+  is allowed even if its path crosses a wall, although the keypad shows
+  it as blocked. Moves that cross the start line backwards are pruned too.
+- The heuristic is based on a distance-to-finish field: the number of
+  cells (8-connected) the car needs to go to cross the start line.
+  With speed s, covering d cells takes at least the smallest k such that
+  s+1 + s+2 + ... + s+k >= d. This never overestimates, so the solution
+  is optimal.
+- States are expanded in batches: all states with the same estimated cost
+  are checked at once, with NumPy.
+
+Results are cached on disk (see levelfile.cache_dir).
+
+Usage: python -m keypad_racer.solver LEVEL.png
+"""
+
+import collections
+import hashlib
+import copy
+import json
+import sys
+import os
+
+import numpy
+
+from . import levelfile
+from .physics import Track, ACTION_DX, ACTION_DY
+
+# Speeds above this (in either axis) are not considered
+MAX_SPEED = 63
+VERSION = 2
+
+Solution = collections.namedtuple('Solution', ('turns', 'actions'))
+# turns: number of turns in the lap
+# actions: list of action numbers (keys of ACTION_DIRECTIONS) to drive it
+
+def distance_to_finish(track):
+    """Compute how many cells each grid cell is from crossing the start line
+
+    Returns a dense [y, x] int32 array; cells that can't reach the line
+    have a large value.
+    Cells next to the track are included, so that moves cutting corners
+    of the track aren't estimated to take too long.
+    """
+    height, width = track.grid.shape
+    on_track = track.grid.region(0, 0, width, height).any(axis=-1)
+    near_track = numpy.zeros_like(on_track)
+    for dy in -1, 0, 1:
+        for dx in -1, 0, 1:
+            near_track |= _shift(on_track, dx, dy, False)
+    ys, xs = numpy.nonzero(near_track)
+    progress = numpy.full((height, width), numpy.nan)
+    near_y, near_x = track.nearest_track_cells.get_many(xs, ys).T
+    reachable = near_y >= 0
+    progress[ys[reachable], xs[reachable]] = track.progress.get_many(
+        near_x[reachable], near_y[reachable],
+    )
+    half_lap = track.lap_length / 2
+
+    unreachable = numpy.iinfo(numpy.int32).max
+    distance = numpy.full((height, width), unreachable, numpy.int32)
+    # Steps to each of the 8 neighbours: crossing the line forwards
+    # finishes; crossing it backwards isn't allowed
+    steps = []
+    for dy in -1, 0, 1:
+        for dx in -1, 0, 1:
+            if dx or dy:
+                neighbour = _shift(progress, -dx, -dy, numpy.nan)
+                steps.append((dx, dy, neighbour))
+                finishes = progress - neighbour > half_lap
+                distance[finishes] = 1
+    frontier = distance == 1
+    current = 1
+    while frontier.any():
+        current += 1
+        new = numpy.zeros_like(frontier)
+        for dx, dy, neighbour in steps:
+            # Cells that can step to (dx, dy) and reach the frontier
+            came_from = _shift(frontier, -dx, -dy, False)
+            new |= came_from & (abs(progress - neighbour) <= half_lap)
+        new &= distance == unreachable
+        distance[new] = current
+        frontier = new
+    return distance
+
+def _shift(array, dx, dy, fill):
+    """Return array[y+dy, x+dx] for each (x, y), with `fill` outside"""
+    height, width = array.shape
+    result = numpy.full_like(array, fill)
+    result[
+        max(-dy, 0):height - max(dy, 0),
+        max(-dx, 0):width - max(dx, 0),
+    ] = array[
+        max(dy, 0):height - max(-dy, 0),
+        max(dx, 0):width - max(-dx, 0),
+    ]
+    return result
+
+def turns_needed(distance, speed):
+    """Lower bound on turns to go `distance` cells, starting at `speed`"""
+    distance = numpy.asarray(distance, numpy.float64)
+    b = 2 * speed + 1
+    turns = numpy.ceil((numpy.sqrt(b * b + 8 * distance) - b) / 2)
+    # Fix up floating-point errors
+    covered = lambda k: k * speed + k * (k + 1) / 2
+    turns = numpy.where(covered(turns - 1) >= distance, turns - 1, turns)
+    turns = numpy.where(covered(turns) < distance, turns + 1, turns)
+    return numpy.maximum(turns, 0).astype(numpy.int64)
+
+def solve(track, pos=(0, 0), velocity=(0, 1), use_cache=True):
+    """Find the lap with fewest turns, starting at pos with velocity
+
+    Returns a Solution, or None if the lap can't be driven.
+    """
+    if track.progress is None:
+        return None
+    cache_path = None
+    if use_cache:
+        cache_path = levelfile.cache_dir() / 'laps' / (
+            _cache_key(track, pos, velocity) + '.json'
+        )
+        try:
+            with open(cache_path) as f:
+                return Solution(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            pass
+    result = _solve(track, pos, velocity)
+    if cache_path and result:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(result._asdict(), f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Caching is optional
+            pass
+    return result
+
+def _cache_key(track, pos, velocity):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+        VERSION, MAX_SPEED, list(pos), list(velocity),
+        track.start_x, track.start_y, list(track.grid.shape),
+    ]).encode())
+    for array in (
+        track.grid.tiles, track.grid.tile_table,
+        track.progress.tiles, track.progress.tile_table,
+    ):
+        digest.update(numpy.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+class _DenseGrid:
+    """Dense copy of a TiledGrid, for faster lookups"""
+    def __init__(self, grid):
+        self.height, self.width = grid.shape
+        # Cells have a border of fill value; coordinates are clamped to it
+        self.cells = numpy.empty(
+            (self.height + 2, self.width + 2, *grid.tiles.shape[3:]),
+            grid.tiles.dtype,
+        )
+        self.cells[...] = grid.fill
+        self.cells[1:-1, 1:-1] = grid.region(0, 0, self.width, self.height)
+
+    def get_many(self, xs, ys):
+        return self.cells[
+            numpy.clip(ys, -1, self.height) + 1,
+            numpy.clip(xs, -1, self.width) + 1,
+        ]
+
+def _solve(track, pos, velocity):
+    height, width = track.grid.shape
+    distance = distance_to_finish(track)
+    # The search does lots of lookups; use dense grids for them
+    track = copy.copy(track)
+    track.grid = _DenseGrid(track.grid)
+    track.progress = _DenseGrid(track.progress)
+    half_lap = track.lap_length / 2
+    span = 2 * MAX_SPEED + 1
+
+    def encode(x, y, vx, vy):
+        x = x + track.start_x
+        y = y + track.start_y
+        return (
+            ((vy + MAX_SPEED) * span + (vx + MAX_SPEED)) * height + y
+        ) * width + x
+
+    def decode(codes):
+        codes, x = numpy.divmod(codes, width)
+        codes, y = numpy.divmod(codes, height)
+        vy, vx = numpy.divmod(codes, span)
+        return (
+            x - track.start_x, y - track.start_y,
+            vx - MAX_SPEED, vy - MAX_SPEED,
+        )
+
+    def estimate(x, y, vx, vy):
+        dist = distance[y + track.start_y, x + track.start_x]
+        speed = numpy.maximum(abs(vx), abs(vy))
+        return turns_needed(dist, speed)
+
+    start = encode(*pos, *velocity)
+    parents = {start: None}
+    # States to expand, as arrays of (code, parent code, action), keyed by
+    # (estimated lap length, -turns). Among states with the same estimate,
+    # ones that got further are expanded first, so the last round doesn't
+    # need to go through all of them.
+    buckets = collections.defaultdict(list)
+    first = estimate(*(numpy.array([c]) for c in (*pos, *velocity)))[0]
+    buckets[first, 0].append(tuple(
+        numpy.array([n], numpy.int64) for n in (start, -1, -1)
+    ))
+    finish = None
+    finish_turns = numpy.inf
+    expanded = set()
+    while buckets:
+        key = min(buckets)
+        if finish_turns <= key[0]:
+            break
+        codes, parent_codes, actions = (
+            numpy.concatenate(arrays) for arrays in zip(*buckets.pop(key))
+        )
+        codes, index = numpy.unique(codes, return_index=True)
+        fresh = _not_in(codes, expanded)
+        codes = codes[fresh]
+        if not len(codes):
+            continue
+        index = index[fresh]
+        code_list = codes.tolist()
+        expanded.update(code_list)
+        if key[1]:
+            parents.update(zip(code_list, zip(
+                parent_codes[index].tolist(), actions[index].tolist(),
+            )))
+        turns = -key[1]
+
+        # Try all actions from all states
+        x, y, vx, vy = decode(codes)
+        x, y, vx, vy, codes = (
+            numpy.repeat(a, len(ACTION_DX)) for a in (x, y, vx, vy, codes)
+        )
+        actions = numpy.tile(numpy.arange(len(ACTION_DX)), len(x) // len(ACTION_DX))
+        vx = vx + ACTION_DX[actions]
+        vy = vy + ACTION_DY[actions]
+        dest_x = x + vx
+        dest_y = y + vy
+        ok = (abs(vx) <= MAX_SPEED) & (abs(vy) <= MAX_SPEED)
+        # As in RacingCar.move: only moves that end off the track crash
+        ok[ok] = track.is_on_track_batch(dest_x[ok], dest_y[ok], check_cars=False)
+        x, y, vx, vy, dest_x, dest_y, codes, actions = (
+            a[ok] for a in (x, y, vx, vy, dest_x, dest_y, codes, actions)
+        )
+        progress_delta = (
+            track.progress.get_many(x + track.start_x, y + track.start_y)
+            - track.progress.get_many(
+                dest_x + track.start_x, dest_y + track.start_y,
+            )
+        )
+        finishes = numpy.flatnonzero(progress_delta > half_lap)
+        if len(finishes) and turns + 1 < finish_turns:
+            finish = codes[finishes[0]], actions[finishes[0]]
+            finish_turns = turns + 1
+
+        ok = abs(progress_delta) <= half_lap
+        new_codes = encode(dest_x[ok], dest_y[ok], vx[ok], vy[ok])
+        fresh = _not_in(new_codes, expanded)
+        ok[ok] = fresh
+        new_codes = new_codes[fresh]
+        new_fs = turns + 1 + estimate(dest_x[ok], dest_y[ok], vx[ok], vy[ok])
+        for f in numpy.unique(new_fs).tolist():
+            in_bucket = new_fs == f
+            buckets[f, -(turns + 1)].append((
+                new_codes[in_bucket], codes[ok][in_bucket],
+                actions[ok][in_bucket],
+            ))
+    if finish is None:
+        return None
+    code, action = finish
+    actions = [int(action)]
+    while parents.get(code) is not None:
+        code, action = parents[code]
+        actions.append(int(action))
+    actions.reverse()
+    return Solution(len(actions), actions)
+
+def _not_in(codes, code_set):
+    """Return a mask of `codes` that aren't in `code_set`"""
+    if not code_set:
+        return numpy.ones(len(codes), bool)
+    missing = set(codes.tolist()) - code_set
+    return numpy.isin(codes, numpy.fromiter(missing, numpy.int64, len(missing)))
+
+def main(argv=sys.argv[1:]):
+    for path in argv:
+        track = Track(path)
+        solution = solve(track)
+        if solution is None:
+            print(f'{path}: no lap found')
+        else:
+            actions = ''.join(str(a) for a in solution.actions)
+            print(f'{path}: {solution.turns} turns: {actions}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""Broadcasting races to spectators
+
+The hosting game publishes the state of all cars (position, velocity, lap,
+crash count and whether the car is crashed) after every turn.
+Each update is encoded once, as a delta against the previous turn, and the
+same bytes are written to all subscribers from a background thread; the
+game's cost doesn't depend on the number of spectators.
+
+Messages use the framing from net.py:
+
+- INFO: JSON {"level": ..., "colors": [...]}
+- KEYFRAME: varint turn number, number of cars, then all FIELDS of all
+  cars (zigzag varints). Sent to new subscribers.
+- DELTA: varint turn number, then for each car that changed: varint car
+  number, varint bit mask of changed FIELDS, and the changes (zigzag
+  varints)
+
+The game publishes when KEYPAD_RACER_SPECTATE is set to [HOST:]PORT.
+To watch:
+
+    python -m keypad_racer.spectate [HOST:]PORT
+"""
+
+import asyncio
+import threading
+import json
+import sys
+import io
+
+from .net import frame, MessageBuffer, set_nodelay, MAX_BACKLOG
+from .replay import encode_varint, read_varint
+from .ghost import zigzag, unzigzag
+
+DEFAULT_PORT = 41338
+
+INFO = b'I'
+KEYFRAME = b'K'
+DELTA = b'D'
+
+FIELDS = ('x', 'y', 'vx', 'vy', 'lap', 'crash_count', 'crashed')
+
+def car_state(car):
+    return (
+        *car.pos, *car.velocity, car.lap, car.crash_count, int(car.crashed),
+    )
+
+def encode_delta(turn, old_states, new_states):
+    data = encode_varint(turn)
+    for i, (old, new) in enumerate(zip(old_states, new_states)):
+        if old == new:
+            continue
+        mask = 0
+        changes = bytearray()
+        for bit, (a, b) in enumerate(zip(old, new)):
+            if a != b:
+                mask |= 1 << bit
+                changes += encode_varint(zigzag(b - a))
+        data += encode_varint(i) + encode_varint(mask) + changes
+    return frame(DELTA, bytes(data))
+
+def encode_keyframe(turn, states):
+    data = encode_varint(turn) + encode_varint(len(states))
+    for state in states:
+        for value in state:
+            data += encode_varint(zigzag(value))
+    return frame(KEYFRAME, bytes(data))
+
+class StateDecoder:
+    """Keeps car states up to date from KEYFRAME and DELTA messages"""
+    def __init__(self):
+        self.turn = None
+        self.states = None
+
+    def feed(self, kind, payload):
+        f = io.BytesIO(payload)
+        if kind == KEYFRAME:
+            self.turn = read_varint(f)
+            num_cars = read_varint(f)
+            self.states = [
+                tuple(unzigzag(read_varint(f)) for field in FIELDS)
+                for i in range(num_cars)
+            ]
+        elif kind == DELTA and self.states is not None:
+            self.turn = read_varint(f)
+            while (i := read_varint(f)) is not None:
+                mask = read_varint(f)
+                state = list(self.states[i])
+                for bit in range(len(FIELDS)):
+                    if mask & (1 << bit):
+                        state[bit] += unzigzag(read_varint(f))
+                self.states[i] = tuple(state)
+
+
+class SpectatorPublisher:
+    """Serves the state of a CarGroup to spectators
+
+    Call `publish` regularly (e.g. every frame); it only sends something
+    if a car changed.
+    """
+    def __init__(self, group, level_path, host='localhost', port=DEFAULT_PORT):
+        self.group = group
+        self.info = frame(INFO, json.dumps({
+            'level': str(level_path),
+            'colors': [list(car.color) for car in group.cars],
+        }).encode())
+        self.turn = 0
+        self.states = [car_state(car) for car in group.cars]
+        # Owned by the background thread:
+        self.subscribers = []
+        self.latest_states = self.states
+        self.latest_turn = 0
+        self.keyframe = None
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.loop.create_server(
+            lambda: _Subscriber(self), host, port,
+        ))
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def publish(self):
+        states = [car_state(car) for car in self.group.cars]
+        if states == self.states:
+            return
+        self.turn += 1
+        message = encode_delta(self.turn, self.states, states)
+        self.states = states
+        self.loop.call_soon_threadsafe(
+            self._broadcast, message, self.turn, states,
+        )
+
+    def _broadcast(self, message, turn, states):
+        self.latest_turn = turn
+        self.latest_states = states
+        # Encoded when someone subscribes
+        self.keyframe = None
+        for subscriber in list(self.subscribers):
+            subscriber.send(message)
+
+    def _subscribe(self, subscriber):
+        if self.keyframe is None:
+            self.keyframe = encode_keyframe(
+                self.latest_turn, self.latest_states,
+            )
+        subscriber.send(self.info)
+        subscriber.send(self.keyframe)
+        self.subscribers.append(subscriber)
+
+    def _unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+class _Subscriber(asyncio.Protocol):
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        set_nodelay(transport)
+        self.publisher._subscribe(self)
+
+    def connection_lost(self, exc):
+        self.publisher._unsubscribe(self)
+
+    def send(self, message):
+        if self.transport.get_write_buffer_size() > MAX_BACKLOG:
+            self.publisher._unsubscribe(self)
+            self.transport.abort()
+            return
+        self.transport.write(message)
+
+
+class SpectatorClient:
+    """Receives a broadcast in a background thread
+
+    `info` is set when connected; `decoder` has the latest states.
+    """
+    def __init__(self, host='localhost', port=DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self.info = None
+        self.decoder = StateDecoder()
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.error = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port,
+            )
+        except OSError as e:
+            self.error = e
+            self.connected.set()
+            return
+        buffer = MessageBuffer()
+        while data := await reader.read(1 << 16):
+            for kind, payload in buffer.feed(data):
+                if kind == INFO:
+                    self.info = json.loads(payload)
+                    continue
+                with self.lock:
+                    self.decoder.feed(kind, payload)
+                if kind == KEYFRAME:
+                    self.connected.set()
+        print('Broadcast ended')
+
+    def get_states(self):
+        """Return the latest (turn, states)"""
+        with self.lock:
+            return self.decoder.turn, self.decoder.states
+
+
+def main(argv=sys.argv[1:]):
+    import pyglet
+
+    from .window import Window
+    from .keyboard import Keyboard
+    from .view import View
+    from .scene import SpectatorScene
+    from .circuit import Circuit
+    from .car import CarGroup, Car
+    from .anim import AnimatedValue, ConstantValue
+
+    class SpectatorCar(Car):
+        def show_state(self, state):
+            x, y, vx, vy, lap, crash_count, crashed = state
+            if (x, y) != self.pos:
+                self.drawn_last_pos = self.drawn_pos
+                self.last_orientation = self._orientation
+                self.turn_towards(x - self.drawn_pos[0], y - self.drawn_pos[1])
+                self.pos = self.drawn_pos = x, y
+                self.push_history((x, y))
+                self.anim_t = AnimatedValue(ConstantValue(0), 1, 0.5)
+            self.velocity = vx, vy
+            self.lap = self.max_lap = lap
+            self.crash_count = crash_count
+            self.crashed = bool(crashed)
+            self.dirty = True
+            self.view_rect = self.get_view_rect()
+
+    address = argv[0] if argv else str(DEFAULT_PORT)
+    host, sep, port = address.rpartition(':')
+    client = SpectatorClient(host or 'localhost', int(port))
+    client.connected.wait()
+    if client.info is None:
+        print(f'Could not connect to {address}: {client.error}')
+        sys.exit(1)
+    turn, states = client.get_states()
+
+    window = Window(Keyboard())
+    ctx = window.ctx
+    circuit = Circuit(ctx, client.info['level'])
+    group = CarGroup(ctx, circuit)
+    cars = [
+        SpectatorCar(group, tuple(color), tuple(state[:2]))
+        for color, state in zip(client.info['colors'], states)
+    ]
+    for car, state in zip(cars, states):
+        car.show_state(state)
+        window.add_view(View(ctx, SpectatorScene(car)))
+
+    shown_turn = turn
+    def update(dt):
+        nonlocal shown_turn
+        turn, states = client.get_states()
+        if turn != shown_turn:
+            shown_turn = turn
+            for car, state in zip(cars, states):
+                car.show_state(state)
+    pyglet.clock.schedule_interval(update, 1/60)
+    pyglet.app.run()
+
+if __name__ == '__main__':
+    main()
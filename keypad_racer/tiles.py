@@ -0,0 +1,206 @@
+import numpy
+
+TILE_SHIFT = 5
+TILE_SIZE = 1 << TILE_SHIFT
+TILE_MASK = TILE_SIZE - 1
+
+class TiledGrid:
+    """2D grid of cells, stored in square tiles of TILE_SIZE×TILE_SIZE cells
+
+    Tiles that only contain the fill value are not stored: they all share
+    tile 0. Indexing is by (x, y), as for the intersection texture.
+
+    tiles: array of shape (n, TILE_SIZE, TILE_SIZE, *cell_shape);
+        tiles[0] is all fill value
+    tile_table: int32 array of shape (tiles_high, tiles_wide);
+        index into `tiles` for each tile of the grid
+    shape: (height, width) of the grid in cells
+    """
+    def __init__(self, tiles, tile_table, shape):
+        self.tiles = tiles
+        self.tile_table = tile_table
+        self.height, self.width = shape
+        self.fill = tiles[0, 0, 0]
+        # Plain lists are faster than numpy for scalar lookups
+        self._table_rows = tile_table.tolist()
+        # All cells, indexed by (tile << 2*TILE_SHIFT) | (y << TILE_SHIFT) | x
+        self._cells = tiles.reshape(-1, *tiles.shape[3:])
+        # Raw bytes of each tile, filled in on first use (see get_bytes)
+        self._tile_bytes = [None] * len(tiles)
+        self._cell_size = self.fill.nbytes
+        self._fill_bytes = self.fill.tobytes()
+
+    @classmethod
+    def from_dense(cls, dense, fill=0, keep=None):
+        """Split a dense [y, x, ...] array into tiles
+
+        Tiles where `keep` (a boolean array of tile_table's shape) is true
+        are stored even if they only contain `fill`.
+        """
+        height, width = dense.shape[:2]
+        cell_shape = dense.shape[2:]
+        tiles_high = -(-height // TILE_SIZE)
+        tiles_wide = -(-width // TILE_SIZE)
+        padded = numpy.full(
+            (tiles_high * TILE_SIZE, tiles_wide * TILE_SIZE, *cell_shape),
+            fill, dense.dtype,
+        )
+        padded[:height, :width] = dense
+        blocks = padded.reshape(
+            tiles_high, TILE_SIZE, tiles_wide, TILE_SIZE, *cell_shape,
+        ).swapaxes(1, 2)
+        stored = (blocks != fill).reshape(tiles_high, tiles_wide, -1).any(-1)
+        if keep is not None:
+            stored |= keep
+        tile_table = numpy.zeros((tiles_high, tiles_wide), numpy.int32)
+        tile_table[stored] = numpy.arange(1, stored.sum() + 1)
+        tiles = numpy.concatenate((
+            numpy.full((1, TILE_SIZE, TILE_SIZE, *cell_shape), fill, dense.dtype),
+            blocks[stored],
+        ))
+        return cls(tiles, tile_table, (height, width))
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    def get(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tile = self._table_rows[y >> TILE_SHIFT][x >> TILE_SHIFT]
+            return self.tiles[tile, y & TILE_MASK, x & TILE_MASK]
+        return self.fill
+
+    def get_bytes(self, x, y):
+        """Like get, but return the cell as bytes
+
+        Indexing bytes gives Python ints, so this is much faster than get
+        for single lookups of uint8 cells.
+        """
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tile = self._table_rows[y >> TILE_SHIFT][x >> TILE_SHIFT]
+            data = self._tile_bytes[tile]
+            if data is None:
+                data = self._tile_bytes[tile] = self.tiles[tile].tobytes()
+            start = (
+                ((y & TILE_MASK) << TILE_SHIFT) | (x & TILE_MASK)
+            ) * self._cell_size
+            return data[start:start + self._cell_size]
+        return self._fill_bytes
+
+    def get_many(self, xs, ys):
+        """Like get, for arrays of coordinates"""
+        xs, ys = numpy.broadcast_arrays(xs, ys)
+        inside = (0 <= xs) & (xs < self.width) & (0 <= ys) & (ys < self.height)
+        # Cells outside the grid are looked up in tile 0, which is all fill
+        tile = self.tile_table[
+            (ys * inside) >> TILE_SHIFT,
+            (xs * inside) >> TILE_SHIFT,
+        ] * inside
+        return self._cells[
+            (tile << 2 * TILE_SHIFT)
+            | ((ys & TILE_MASK) << TILE_SHIFT)
+            | (xs & TILE_MASK)
+        ]
+
+    def region(self, x0, y0, x1, y1):
+        """Return the cells in a rectangle as a dense [y, x, ...] array
+
+        The rectangle may extend outside the grid.
+        """
+        xs = numpy.arange(x0, x1)
+        ys = numpy.arange(y0, y1)[:, None]
+        return self.get_many(xs, ys)
+
+    def stored_tiles(self):
+        """Return (tile_y, tile_x) coordinates of stored tiles"""
+        return numpy.argwhere(self.tile_table > 0)
+
+def nearest_cells(grid):
+    """Find the nearest non-empty cell for cells of a TiledGrid
+
+    Returns a TiledGrid of (y, x) coordinates of the nearest cell that
+    isn't all zero.
+    The result only covers tiles that are stored in `grid`, and a margin of
+    one tile around them; elsewhere it has (-1, -1).
+    """
+    keep = _dilate(grid.tile_table > 0)
+    result_tiles = [numpy.full((TILE_SIZE, TILE_SIZE, 2), -1, numpy.int32)]
+    tile_table = numpy.zeros(keep.shape, numpy.int32)
+    # Look at a window of 2 tiles around each tile, so the result is exact
+    # for cells closer than 2 tiles to the track
+    margin = 2 * TILE_SIZE
+    for tile_y, tile_x in numpy.argwhere(keep):
+        x0 = tile_x * TILE_SIZE - margin
+        y0 = tile_y * TILE_SIZE - margin
+        size = TILE_SIZE + 2 * margin
+        window = grid.region(x0, y0, x0 + size, y0 + size)
+        window_mask = window.reshape(size, size, -1).any(axis=-1)
+        nearest = nearest_true_cells(window_mask)
+        if nearest is None:
+            continue
+        tile = nearest[margin:-margin, margin:-margin] + (y0, x0)
+        tile_table[tile_y, tile_x] = len(result_tiles)
+        result_tiles.append(tile.astype(numpy.int32))
+    return TiledGrid(
+        numpy.stack(result_tiles),
+        tile_table,
+        grid.shape,
+    )
+
+def _dilate(mask):
+    """Grow a 2D boolean array by one cell in all 8 directions"""
+    padded = numpy.pad(mask, 1)
+    result = numpy.zeros_like(mask)
+    height, width = mask.shape
+    for dy in range(3):
+        for dx in range(3):
+            result |= padded[dy:dy+height, dx:dx+width]
+    return result
+
+def nearest_true_cells(mask):
+    """Euclidean feature transform of a 2D boolean array
+
+    Returns an array of (row, column) indices of the nearest true cell
+    for each cell, or None if there are no true cells.
+    """
+    if not mask.any():
+        return None
+    height, width = mask.shape
+    no_cell = 2 ** 40
+
+    # Nearest true cell in the same row
+    cols = numpy.arange(width)
+    left = numpy.where(mask, cols, -1)
+    numpy.maximum.accumulate(left, axis=1, out=left)
+    right = numpy.where(mask, cols, width * 3)
+    right = numpy.minimum.accumulate(right[:, ::-1], axis=1)[:, ::-1]
+    nearest_cols = numpy.where(
+        (left >= 0) & (cols - left <= right - cols), left, right,
+    )
+    row_dists = numpy.where(
+        mask.any(axis=1)[:, None],
+        (nearest_cols - cols) ** 2,
+        no_cell,
+    )
+
+    # Combine with the rows above and below, until they're too far away
+    rows = numpy.arange(height)[:, None]
+    best_dists = row_dists.copy()
+    best_rows = numpy.broadcast_to(rows, mask.shape).copy()
+    for d in range(1, height):
+        if d * d >= best_dists.max():
+            break
+        for dest, src in (
+            (slice(d, None), slice(None, -d)),
+            (slice(None, -d), slice(d, None)),
+        ):
+            candidates = row_dists[src] + d * d
+            better = candidates < best_dists[dest]
+            best_dists[dest][better] = candidates[better]
+            best_rows[dest][better] = numpy.broadcast_to(
+                rows[src], better.shape,
+            )[better]
+    return numpy.stack(
+        (best_rows, numpy.take_along_axis(nearest_cols, best_rows, axis=0)),
+        axis=-1,
+    )
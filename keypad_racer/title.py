@@ -1,18 +1,24 @@
+from pathlib import Path
 import random
 from functools import partial
+import time
 import os
 
 import pyglet
 
-from .scene import Scene, KeypadScene, CarScene
+from .scene import Scene, KeypadScene, CarScene, SpectatorScene
 from .text import Text
 from .palette import COLORS
 from .anim import AnimatedValue, ConstantValue, sine_in
 from .keypad import Keypad
 from .keyboard import keylabel
 from .view import View
-from .car import CarGroup, Car
+from .car import CarGroup, Car, get_trail_length, HISTORY_SIZE
+from .replay import ReplayWriter
+from .spectate import SpectatorPublisher
 from . import keyboard
+from . import ghost
+from . import net
 
 def animN(src, dest, *args, **kwargs):
     return tuple(
@@ -222,10 +228,14 @@ class TitleBottom(KeypadScene):
         return 1, 1, 1
 
     def start_game(self):
+        server = os.environ.get('KEYPAD_RACER_SERVER')
+        if server:
+            self.start_network_game(server)
+            return
         for player in self.players:
             player.clear_callbacks()
         self.window.views.clear()
-        car_group = CarGroup(self.ctx, self.circuit)
+        car_group = self.make_car_group()
         def _gen_xpositions():
             i = 0
             yield i
@@ -235,12 +245,100 @@ class TitleBottom(KeypadScene):
                 yield -i
         for x, player in zip(_gen_xpositions(), self.players):
             car = Car(car_group, player.color, (x, 0))
-            car.keypad = player
-            player.car = car
-            player.update()
-            scene = CarScene(car, player)
-            view = View(self.ctx, scene)
-            self.window.add_view(view)
+            self.add_driver(car, player)
+        self.start_recording(car_group)
+
+    def start_network_game(self, server):
+        host, sep, port = server.rpartition(':')
+        if not sep:
+            host, port = server, net.DEFAULT_PORT
+        # Wait for the other players without blocking the window
+        self.keypad.enabled = False
+        link = net.NetworkLink(
+            host, int(port), [player.color for player in self.players],
+            self.circuit,
+        )
+        def check_start(dt):
+            if not link.started.is_set():
+                return
+            pyglet.clock.unschedule(check_start)
+            start = link.client.start
+            if start is None:
+                print(f'Could not connect to {server}: {link.error}')
+                self.keypad.enabled = True
+                return
+            for player in self.players:
+                player.clear_callbacks()
+            self.window.views.clear()
+            car_group = self.make_car_group()
+            car_group.link = link
+            car_group.race_time = 0
+            players = iter(self.players)
+            if not start['yours']:
+                print('The race has already started; watching it')
+            for i, (pos, color) in enumerate(zip(start['cars'], start['colors'])):
+                car = Car(car_group, tuple(color), tuple(pos))
+                if i in start['yours']:
+                    self.add_driver(car, next(players))
+                elif not start['yours']:
+                    # Joined late: the server doesn't give us any cars
+                    self.window.add_view(View(self.ctx, SpectatorScene(car)))
+            self.start_recording(car_group)
+            pyglet.clock.schedule_interval(
+                lambda dt: link.apply(car_group), 1/60,
+            )
+        pyglet.clock.schedule_interval(check_start, 1/10)
+
+    def make_car_group(self):
+        # KEYPAD_RACER_TRAIL: trail length, a number of points or "lap"
+        trail = os.environ.get('KEYPAD_RACER_TRAIL', HISTORY_SIZE)
+        return CarGroup(
+            self.ctx, self.circuit,
+            trail_length=get_trail_length(self.circuit, trail),
+        )
+
+    def add_driver(self, car, player):
+        car.keypad = player
+        player.car = car
+        if player.player_name and self.circuit.level_path:
+            car.load_best_lap(ghost.lap_path(
+                self.circuit.level_path, player.player_name,
+            ))
+        player.update()
+        scene = CarScene(car, player)
+        view = View(self.ctx, scene)
+        self.window.add_view(view)
+
+    def start_recording(self, car_group):
+        # KEYPAD_RACER_RECORD: directory to save replays of races in
+        directory = os.environ.get('KEYPAD_RACER_RECORD')
+        if directory:
+            try:
+                recorder = ReplayWriter(
+                    Path(directory) / time.strftime('%Y%m%d-%H%M%S.krr'),
+                    self.circuit,
+                    [car.pos for car in car_group.cars],
+                )
+            except OSError as e:
+                print(f'Not recording a replay: {e}')
+            else:
+                car_group.recorder = recorder
+                # The race lasts until the game exits
+                pyglet.app.event_loop.push_handlers(on_exit=recorder.close)
+        address = os.environ.get('KEYPAD_RACER_SPECTATE')
+        if address:
+            host, sep, port = address.rpartition(':')
+            try:
+                publisher = SpectatorPublisher(
+                    car_group, self.circuit.level_path,
+                    host or 'localhost', int(port),
+                )
+            except OSError as e:
+                print(f'Not broadcasting to spectators: {e}')
+            else:
+                pyglet.clock.schedule_interval(
+                    lambda dt: publisher.publish(), 1/60,
+                )
 
 class Caption:
     def __init__(self, ctx, keypad, button, template, unassigned_message,
@@ -0,0 +1,243 @@
+"""Bot tournament: race driving policies against each other, without a window
+
+Usage:
+
+    python -m keypad_racer.tournament [options] POLICY [POLICY ...]
+
+Each race has one car per policy. The cars start on a grid (in the same
+places as in the game), in a different order for each race.
+Races are run in a pool of processes; each worker loads the level once
+(memory-mapped from the compiled level cache).
+Results are written as JSON lines: one line per race as it finishes, then
+one summary line per policy.
+
+A policy is one of the built-in ones (see POLICIES), or "module:function".
+It's called as function(car, rng) and returns an action number (see
+ACTION_DIRECTIONS); `car` is a RacingCar and `rng` a random.Random.
+"""
+
+import multiprocessing
+import collections
+import importlib
+import argparse
+import random
+import json
+import sys
+
+from . import levelfile
+from .physics import Track, RacingCar, ACTION_DIRECTIONS
+
+def random_policy(car, rng):
+    """Pick any action that doesn't crash"""
+    blockers = car.blockers_for_all_actions()
+    safe = [a for a in ACTION_DIRECTIONS if not blockers[a]]
+    if not safe:
+        return 4
+    return rng.choice(safe)
+
+def speed_limited_policy(max_speed):
+    """Make a policy that goes forward as fast as it can, up to max_speed
+
+    Actions that crash, or that lead to a state where every action
+    crashes, are avoided.
+    """
+    def policy(car, rng):
+        track = car.track
+        x, y = car.pos
+        vx, vy = car.velocity
+        blockers = car.blockers_for_all_actions()
+        candidates = []
+        for action, (dx, dy) in ACTION_DIRECTIONS.items():
+            new_vx = vx + dx
+            new_vy = vy + dy
+            if blockers[action] or max(abs(new_vx), abs(new_vy)) > max_speed:
+                continue
+            dest = x + new_vx, y + new_vy
+            next_ts = track.action_crash_ts(*dest, new_vx, new_vy)[0]
+            if not (next_ts == float('inf')).any():
+                continue
+            progress = track.progress_at(*dest)
+            if progress is None:
+                continue
+            gain = (progress - car.track_progress) % track.lap_length
+            if gain > track.lap_length / 2:
+                # Going backwards
+                gain -= track.lap_length
+            candidates.append((gain, rng.random(), action))
+        if not candidates:
+            return random_policy(car, rng)
+        return max(candidates)[2]
+    return policy
+
+POLICIES = {
+    'random': random_policy,
+    'cautious': speed_limited_policy(3),
+    'greedy': speed_limited_policy(6),
+}
+
+def get_policy(name):
+    if name in POLICIES:
+        return POLICIES[name]
+    module_name, sep, function_name = name.partition(':')
+    if not sep:
+        raise ValueError(f'unknown policy: {name}')
+    return getattr(importlib.import_module(module_name), function_name)
+
+class BotCar(RacingCar):
+    def __init__(self, track, pos, policy_name):
+        super().__init__(track, pos)
+        self.policy_name = policy_name
+        self.policy = get_policy(policy_name)
+        self.turn = 0
+        self.lap_turns = []
+        self.last_lap_start = 0
+        self.finish_turn = None
+
+    def on_new_lap(self):
+        self.lap_turns.append(self.turn - self.last_lap_start)
+        self.last_lap_start = self.turn
+
+def grid_positions():
+    """Starting positions, in the order the game uses"""
+    yield 0, 0
+    x = 0
+    while True:
+        x += 1
+        yield x, 0
+        yield -x, 0
+
+_track = None
+
+def _init_worker(level_path):
+    global _track
+    _track = Track(levelfile.load(level_path))
+
+def run_race(task):
+    """Run one race; return its results as a dict
+
+    `task` is (race number, policy names in grid order, laps, max turns,
+    random seed).
+    """
+    race_number, policy_names, laps, max_turns, seed = task
+    # Cars from previous races in this worker aren't on the track any more
+    _track.cars.clear()
+    _track.occupancy.clear()
+    rng = random.Random(seed)
+    cars = [
+        BotCar(_track, pos, name)
+        for pos, name in zip(grid_positions(), policy_names)
+    ]
+    finished = []
+    turn = 0
+    while turn < max_turns and len(finished) < len(cars):
+        turn += 1
+        for car in cars:
+            if car.finish_turn is not None:
+                continue
+            car.turn = turn
+            car.act(car.policy(car, rng))
+            if car.lap > laps:
+                car.finish_turn = turn
+                finished.append(car)
+    # Cars that didn't finish are ordered by how far they got
+    unfinished = sorted(
+        (car for car in cars if car.finish_turn is None),
+        key=lambda car: -car.race_distance,
+    )
+    return {
+        'type': 'race',
+        'race': race_number,
+        'seed': seed,
+        'turns': turn,
+        'cars': [
+            {
+                'policy': car.policy_name,
+                'grid_position': cars.index(car) + 1,
+                'position': position,
+                'finished': car.finish_turn is not None,
+                'finish_turn': car.finish_turn,
+                'lap_turns': car.lap_turns,
+                'crashes': car.crash_count,
+                'distance': round(car.race_distance, 2),
+            }
+            for position, car in enumerate(finished + unfinished, start=1)
+        ],
+    }
+
+def summarize(results):
+    """Aggregate race results by policy"""
+    stats = collections.defaultdict(lambda: {
+        'races': 0, 'wins': 0, 'finished': 0, 'positions': [],
+        'lap_turns': [], 'crashes': 0,
+    })
+    for result in results:
+        for car in result['cars']:
+            policy_stats = stats[car['policy']]
+            policy_stats['races'] += 1
+            policy_stats['wins'] += car['position'] == 1
+            policy_stats['finished'] += car['finished']
+            policy_stats['positions'].append(car['position'])
+            policy_stats['lap_turns'].extend(car['lap_turns'])
+            policy_stats['crashes'] += car['crashes']
+    summaries = []
+    for policy, policy_stats in stats.items():
+        positions = policy_stats.pop('positions')
+        lap_turns = policy_stats.pop('lap_turns')
+        summaries.append({
+            'type': 'summary',
+            'policy': policy,
+            **policy_stats,
+            'mean_position': sum(positions) / len(positions),
+            'laps': len(lap_turns),
+            'best_lap_turns': min(lap_turns, default=None),
+            'mean_lap_turns': (
+                sum(lap_turns) / len(lap_turns) if lap_turns else None
+            ),
+            'crashes_per_race': policy_stats['crashes'] / len(positions),
+        })
+    summaries.sort(key=lambda s: s['mean_position'])
+    return summaries
+
+def make_tasks(policy_names, races, laps, max_turns, seed):
+    rng = random.Random(seed)
+    for race_number in range(races):
+        names = list(policy_names)
+        rng.shuffle(names)
+        yield race_number, names, laps, max_turns, rng.randrange(2**32)
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        prog='python -m keypad_racer.tournament',
+        description='Race bot policies against each other.',
+    )
+    parser.add_argument('policies', nargs='+', metavar='POLICY',
+        help=f'built-in policy ({", ".join(POLICIES)}) or module:function')
+    parser.add_argument('--level', default='okruh.png')
+    parser.add_argument('--grids', type=int, default=10,
+        help='number of races, each with a different starting grid')
+    parser.add_argument('--laps', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None,
+        help='worker processes (default: one per CPU)')
+    args = parser.parse_args(argv)
+    for name in args.policies:
+        get_policy(name)
+
+    # Compile the level into the cache, so workers can map it
+    levelfile.load(args.level)
+    tasks = make_tasks(
+        args.policies, args.grids, args.laps, args.max_turns, args.seed,
+    )
+    results = []
+    with multiprocessing.Pool(
+        args.processes, initializer=_init_worker, initargs=(args.level,),
+    ) as pool:
+        for result in pool.imap_unordered(run_race, tasks):
+            results.append(result)
+            print(json.dumps(result), flush=True)
+    for summary in summarize(results):
+        print(json.dumps(summary), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -104,17 +104,24 @@ class View:
             AnimatedValue(self.pan[1], self.pan[1].end - dy, duration),
         )
 
-    def setup(self, *programs):
-        viewport = tuple(round(c) for c in self.viewport)
+    def current_params(self):
         params = self._params
-        self.ctx.scissor = viewport
-        self.ctx.viewport = viewport
-        params = (
+        return (
             float(params.x) + float(self.pan[0]),
             float(params.y) + float(self.pan[1]),
             float(params.scale_x) * float(self.zoom),
             float(params.scale_y) * float(self.zoom),
         )
+
+    def visible_rect(self):
+        x, y, scale_x, scale_y = self.current_params()
+        return x - scale_x, y - scale_y, x + scale_x, y + scale_y
+
+    def setup(self, *programs):
+        viewport = tuple(round(c) for c in self.viewport)
+        self.ctx.scissor = viewport
+        self.ctx.viewport = viewport
+        params = self.current_params()
         for program in programs:
             program['viewport'] = viewport
             program['projection_params'] = params
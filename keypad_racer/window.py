@@ -59,15 +59,19 @@ class PygletWindow(pyglet.window.Window):
     def on_draw(self):
         pass
 
+def setup_context(ctx):
+    ctx.extra = types.SimpleNamespace()
+    ctx.blend_func = ctx.SRC_ALPHA, ctx.ONE_MINUS_SRC_ALPHA
+    ctx.enable_only(moderngl.BLEND | moderngl.PROGRAM_POINT_SIZE)
+
 class Window:
     def __init__(self, kbd):
         self.pyglet_window = wnd = PygletWindow()
         self.scenes = []
 
         self.ctx = ctx = moderngl.create_context()
-        ctx.extra = types.SimpleNamespace()
-        ctx.blend_func = ctx.SRC_ALPHA, ctx.ONE_MINUS_SRC_ALPHA
-        ctx.enable_only(moderngl.BLEND | moderngl.PROGRAM_POINT_SIZE)
+        setup_context(ctx)
+        self.fbo = ctx.screen
 
         self.dragged_view = None
         wnd.event(self.on_draw)
@@ -92,11 +96,9 @@ class Window:
         print("version code:", self.ctx.version_code)
 
     def on_draw(self):
-        fbo = self.ctx.screen
-        fbo.use()
-        self.ctx.scissor = (
-            0, 0, self.pyglet_window.width, self.pyglet_window.height,
-        )
+        self.fbo.use()
+        width, height = self.get_size()
+        self.ctx.scissor = (0, 0, width, height)
         self.ctx.clear(0.0, 0.0, 0.0, 0.0)
         for view in self.views:
             view.draw()
@@ -141,8 +143,14 @@ class Window:
             if view.hit_test(x, y):
                 return view
 
+    def get_size(self):
+        return self.pyglet_window.width, self.pyglet_window.height
+
+    def get_framebuffer_size(self):
+        return self.pyglet_window.get_framebuffer_size()
+
     def on_resize(self, w, h):
-        width, height = self.pyglet_window.get_framebuffer_size()
+        width, height = self.get_framebuffer_size()
         border = max(width/100, height/100)
         normal_views = []
         bottom = 0
@@ -196,8 +204,7 @@ class Window:
             view.set_viewport((x, y, w, h))
 
     def add_view(self, view):
-        w = self.pyglet_window.width
-        h = self.pyglet_window.height
+        w, h = self.get_size()
         view.viewport = w, 0, 0, h
         self.views.append(view)
         self.on_resize(w, h)
@@ -207,7 +214,7 @@ class Window:
             self.views.remove(view)
         except ValueError:
             pass
-        self.on_resize(self.pyglet_window.width, self.pyglet_window.height)
+        self.on_resize(*self.get_size())
 
     @property
     def fullscreen(self):
@@ -225,3 +232,39 @@ class Window:
     def toggle_fullscreen(self):
         self.fullscreen = not self.fullscreen
 
+class OffscreenWindow(Window):
+    """Window-like stack of views, drawn into an offscreen framebuffer
+
+    Uses a standalone context, so it works without a display (or GPU,
+    with a software renderer like llvmpipe).
+    """
+    def __init__(self, size=(800, 600)):
+        self.pyglet_window = None
+        self.size = size
+        try:
+            self.ctx = ctx = moderngl.create_standalone_context(backend='egl')
+        except Exception:
+            self.ctx = ctx = moderngl.create_standalone_context()
+        # Standalone contexts need to be made current for drawing
+        ctx.__enter__()
+        setup_context(ctx)
+        self.fbo = ctx.simple_framebuffer(size)
+        self.dragged_view = None
+        self.views = []
+
+    def get_size(self):
+        return self.size
+
+    def get_framebuffer_size(self):
+        return self.size
+
+    def read(self):
+        """Return the drawn image, as bytes of RGB rows (bottom row first)"""
+        return self.fbo.read()
+
+    @property
+    def fullscreen(self):
+        return False
+    @fullscreen.setter
+    def fullscreen(self, new):
+        pass
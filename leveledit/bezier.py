@@ -0,0 +1,130 @@
+"""Bézier curves for the level editor
+
+This doesn't need a window, so it can be used (and benchmarked) on its own.
+"""
+
+import collections
+import itertools
+import math
+
+import numpy
+
+class Yield:
+    def __await__(self):
+        yield 0
+Yield = Yield()
+
+def normalize(v):
+    return v / numpy.linalg.norm(v)
+
+class Bezier:
+    """Cubic de Casteljau/Bézier curve"""
+    def __init__(self, p0, p1, p2, p3):
+        self.points = [numpy.array(p) for p in (p0, p1, p2, p3)]
+        self.subdivisions = []
+
+    def evaluate(self, t):
+        return (
+            (1-t)**3 * self.points[0]
+            + 3 * (1-t)**2 * t * self.points[1]
+            + 3 * (1-t) * t**2 * self.points[2]
+            + t**3 * self.points[3]
+        )
+
+    def evaluate_tangent(self, t):
+        v = (
+            (-3 * (1-t)**2) * self.points[0]
+            + ((3*(1-t)**2 - 6*t*(1-t))) * self.points[1]
+            + (- 3*t**2 + 6*t*(1-t)) * self.points[2]
+            + 3 * t**2 * self.points[3]
+        )
+        if (v == 0).all():
+            # Zero "speed" -> use tangent of entire curve
+            return normalize(self.points[3] - self.points[0])
+        return normalize(v)
+
+    async def subdivide(self):
+        EPSILON = 0.001
+        EPSILON2 = 0.01
+        EPSILON3 = 0.00001
+        nums = itertools.count()
+        self.subdivisions = []
+        def add_subdiv(t, pt, crossings):
+            p = PointAtBezier(t, next(nums), pt, crossings)
+            p.tangent = self.evaluate_tangent(t)
+            p.curve = self
+            self.subdivisions.append(p)
+        def is_almost_int(w):
+            r = round(w)
+            return abs(w-r) < EPSILON3
+        for t in 0, 1:
+            crossings = {'s'}
+            x, y = pt = self.evaluate(t)
+            if is_almost_int(x):
+                x = round(x)
+                crossings.add('y')
+            if is_almost_int(y):
+                y = round(y)
+                crossings.add('x')
+            add_subdiv(t, numpy.array([x, y]), crossings)
+        def do_subdiv():
+            self.subdivisions.sort()
+            for s0, s1 in zip(self.subdivisions, self.subdivisions[1:]):
+                for axis_name, crossing_name, axis in ('x', 'y', 0), ('y', 'x', 1):
+                    a0 = s0.pt[axis]
+                    a1 = s1.pt[axis]
+                    if math.floor(a0) == math.floor(a1):
+                        continue
+                    if math.floor(a0) == a0 and abs(a0-a1) <= 1:
+                        continue
+                    if math.floor(a1) == a1 and abs(a0-a1) <= 1:
+                        continue
+                    a0 = self.evaluate(s0.t)[axis]
+                    a1 = self.evaluate(s1.t)[axis]
+                    ra0 = math.floor(a0)
+                    if ra0 == math.floor(a1):
+                        continue
+                    lower = s0.t
+                    higher = s1.t
+                    mid_t = (lower + higher)/2
+                    while abs(higher - lower) > 0.000001:
+                        mid_a = self.evaluate(mid_t)[axis]
+                        same = (math.floor(mid_a) == ra0)
+                        if same:
+                            lower = mid_t
+                        else:
+                            higher = mid_t
+                        mid_t = (lower+higher)/2
+                    pt = self.evaluate(mid_t)
+                    pt[axis] = round(pt[axis])
+                    add_subdiv(mid_t, pt, {crossing_name})
+                    return True
+            halved_something = False
+            for s0, s1 in zip(self.subdivisions, self.subdivisions[1:]):
+                if numpy.linalg.norm(s1.pt - s0.pt) > EPSILON:
+                    for halving in (0.5,):
+                        mid_t = (1-halving) * s0.t + halving * s1.t
+                        pt = self.evaluate(mid_t)
+
+                        line = s0.pt - s1.pt
+                        direction = n = numpy.linalg.norm(line)
+                        distance = abs(numpy.cross(pt - s0.pt, s1.pt - s0.pt))
+                        if distance > EPSILON2:
+                            add_subdiv(mid_t, pt, {'c'})
+                            halved_something = True
+            return halved_something
+        while do_subdiv():
+            self.subdivisions.sort()
+            await Yield
+        merged_subdivisions = []
+        current = None
+        for div in self.subdivisions:
+            if current is None or div.t != current.t:
+                merged_subdivisions.append(div)
+                current = div
+            else:
+                current.c.update(div.c)
+        self.subdivisions = merged_subdivisions
+
+class PointAtBezier(collections.namedtuple('P', ['t', 'n', 'pt', 'c'])):
+    pass
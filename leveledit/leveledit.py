@@ -24,6 +24,9 @@ Auxiliary file:
 Output:
 - Level file `LEVEL_NAME.png`, containing collision data (as the image),
   rail data (as a custom chunks) and a copy of the auxiliary file.
+- Compiled level `LEVEL_NAME.krc`, with the same data plus precomputed
+  tables, ready for the game to memory-map.
+  (This needs the game's requirements -- pypng -- installed as well.)
 
 Controls:
 - Middle mouse button: drag to pan
@@ -55,6 +58,10 @@ import numpy
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from keypad_racer import levelfile
+from bezier import Bezier, Yield, normalize
+
 try:
     level_name = sys.argv[1]
 except IndexError:
@@ -79,11 +86,6 @@ if 'GAME_DEVEL_ENVIRON' in os.environ:
 if 'GAME_DEVEL_ENVIRON2' in os.environ:
     window.set_location(1100, 0)
 
-class Yield:
-    def __await__(self):
-        yield 0
-Yield = Yield()
-
 def parse_svg_path(path):
     print(path)
     path_iter = iter(re.split('[ ,]+', path))
@@ -466,6 +468,13 @@ class EditorState:
             round(start.x - xmin), round(start.y - ymin)
         ))
         img.save(self.output_path, pnginfo=pnginfo)
+        level = levelfile.read_png(self.output_path.read_bytes())
+        levelfile.write_compiled(
+            self.output_path.with_suffix('.krc'),
+            levelfile.compile_level(
+                level, crash_table_speed=levelfile.CRASH_TABLE_SPEED,
+            ),
+        )
         print('Level saved')
 
     def draw(self):
@@ -602,9 +611,6 @@ class EditorState:
                 pyglet.gl.glVertex2f(*point)
         pyglet.gl.glEnd()
 
-def normalize(v):
-    return v / numpy.linalg.norm(v)
-
 class Segment:
     def __init__(self, state, start, control1, control2, end):
         if isinstance(start, Node):
@@ -678,118 +684,6 @@ def _gen_halvings(a, b):
         yield n
 HALVINGS = tuple(_gen_halvings(0, 1))
 
-class Bezier:
-    """Cubic de Casteljau/Bézier curve"""
-    def __init__(self, p0, p1, p2, p3):
-        self.points = [numpy.array(p) for p in (p0, p1, p2, p3)]
-        self.subdivisions = []
-
-    def evaluate(self, t):
-        return (
-            (1-t)**3 * self.points[0]
-            + 3 * (1-t)**2 * t * self.points[1]
-            + 3 * (1-t) * t**2 * self.points[2]
-            + t**3 * self.points[3]
-        )
-
-    def evaluate_tangent(self, t):
-        v = (
-            (-3 * (1-t)**2) * self.points[0]
-            + ((3*(1-t)**2 - 6*t*(1-t))) * self.points[1]
-            + (- 3*t**2 + 6*t*(1-t)) * self.points[2]
-            + 3 * t**2 * self.points[3]
-        )
-        if (v == 0).all():
-            # Zero "speed" -> use tangent of entire curve
-            return normalize(self.points[3] - self.points[0])
-        return normalize(v)
-
-    async def subdivide(self):
-        EPSILON = 0.001
-        EPSILON2 = 0.01
-        EPSILON3 = 0.00001
-        nums = itertools.count()
-        self.subdivisions = []
-        def add_subdiv(t, pt, crossings):
-            p = PointAtBezier(t, next(nums), pt, crossings)
-            p.tangent = self.evaluate_tangent(t)
-            p.curve = self
-            self.subdivisions.append(p)
-        def is_almost_int(w):
-            r = round(w)
-            return abs(w-r) < EPSILON3
-        for t in 0, 1:
-            crossings = {'s'}
-            x, y = pt = self.evaluate(t)
-            if is_almost_int(x):
-                x = round(x)
-                crossings.add('y')
-            if is_almost_int(y):
-                y = round(y)
-                crossings.add('x')
-            add_subdiv(t, numpy.array([x, y]), crossings)
-        def do_subdiv():
-            self.subdivisions.sort()
-            for s0, s1 in zip(self.subdivisions, self.subdivisions[1:]):
-                for axis_name, crossing_name, axis in ('x', 'y', 0), ('y', 'x', 1):
-                    a0 = s0.pt[axis]
-                    a1 = s1.pt[axis]
-                    if math.floor(a0) == math.floor(a1):
-                        continue
-                    if math.floor(a0) == a0 and abs(a0-a1) <= 1:
-                        continue
-                    if math.floor(a1) == a1 and abs(a0-a1) <= 1:
-                        continue
-                    a0 = self.evaluate(s0.t)[axis]
-                    a1 = self.evaluate(s1.t)[axis]
-                    ra0 = math.floor(a0)
-                    if ra0 == math.floor(a1):
-                        continue
-                    lower = s0.t
-                    higher = s1.t
-                    mid_t = (lower + higher)/2
-                    while abs(higher - lower) > 0.000001:
-                        mid_a = self.evaluate(mid_t)[axis]
-                        same = (math.floor(mid_a) == ra0)
-                        if same:
-                            lower = mid_t
-                        else:
-                            higher = mid_t
-                        mid_t = (lower+higher)/2
-                    pt = self.evaluate(mid_t)
-                    pt[axis] = round(pt[axis])
-                    add_subdiv(mid_t, pt, {crossing_name})
-                    return True
-            halved_something = False
-            for s0, s1 in zip(self.subdivisions, self.subdivisions[1:]):
-                if numpy.linalg.norm(s1.pt - s0.pt) > EPSILON:
-                    for halving in (0.5,):
-                        mid_t = (1-halving) * s0.t + halving * s1.t
-                        pt = self.evaluate(mid_t)
-
-                        line = s0.pt - s1.pt
-                        direction = n = numpy.linalg.norm(line)
-                        distance = abs(numpy.cross(pt - s0.pt, s1.pt - s0.pt))
-                        if distance > EPSILON2:
-                            add_subdiv(mid_t, pt, {'c'})
-                            halved_something = True
-            return halved_something
-        while do_subdiv():
-            self.subdivisions.sort()
-            await Yield
-        merged_subdivisions = []
-        current = None
-        for div in self.subdivisions:
-            if current is None or div.t != current.t:
-                merged_subdivisions.append(div)
-                current = div
-            else:
-                current.c.update(div.c)
-        self.subdivisions = merged_subdivisions
-
-class PointAtBezier(collections.namedtuple('P', ['t', 'n', 'pt', 'c'])):
-    pass
-
 class Node(collections.namedtuple('C', ['x', 'y'])):
     def __init__(self, x, y):
         self.vec = numpy.array([x, y])
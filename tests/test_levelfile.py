@@ -0,0 +1,51 @@
+from pathlib import Path
+import subprocess
+import struct
+import zlib
+import sys
+import io
+
+import png
+
+from keypad_racer import levelfile
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def write_ring_level(path, size=24, width=6):
+    """Write a small level: a square ring of track, with rails around it"""
+    rows = []
+    for y in range(size):
+        row = []
+        for x in range(size):
+            on_track = min(x, y, size-1-x, size-1-y) < width
+            row.extend([255] * 4 if on_track else [0] * 4)
+        rows.append(row)
+    data = io.BytesIO()
+    png.Writer(size, size, greyscale=False, alpha=True).write(data, rows)
+    chunks = list(png.Reader(bytes=data.getvalue()).chunks())
+
+    def rail(lo, hi):
+        corners = (lo, lo), (hi, lo), (hi, hi), (lo, hi), (lo, lo)
+        points = [corners[0], *corners, corners[-1]]
+        return zlib.compress(b''.join(struct.pack('<ee', *p) for p in points))
+    # After IHDR, as the level editor writes them
+    level_chunks = [
+        (b'raIl', rail(0, size)),
+        (b'raIl', rail(width, size - width)),
+        (b'stRt', struct.pack('<ii', width // 2, size // 2)),
+    ]
+    with open(path, 'wb') as f:
+        png.write_chunks(f, chunks[:1] + level_chunks + chunks[1:])
+
+def test_compile_cli(tmp_path):
+    path = tmp_path / 'ring.png'
+    write_ring_level(path)
+    subprocess.run(
+        [sys.executable, '-m', 'keypad_racer.levelfile', str(path)],
+        cwd=ROOT, check=True,
+    )
+    level = levelfile.read_compiled(path.with_suffix('.krc'))
+    assert level.start == (3, 12)
+    assert level.grid.shape == (24, 24)
+    assert 'crash_table' in level.tables
+    assert levelfile.load(path).tables.keys() == level.tables.keys()